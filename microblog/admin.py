@@ -10,6 +10,10 @@ class PostAdmin(admin.ModelAdmin):
     list_display = ('headline', 'date', 'author', 'status')
     ordering = ('-date',)
 
+    def queryset(self, request):
+        # headline ha bisogno dei PostContent di tutti i post mostrati
+        return super(PostAdmin, self).queryset(request).with_contents()
+
     def headline(self, obj):
         contents = dict((c.language, c) for c in obj.postcontent_set.all())
         for l, lname in settings.LANGUAGES:
@@ -97,24 +101,27 @@ class PostAdmin(admin.ModelAdmin):
         return PostForm
 
     def save_model(self, request, obj, form, change):
-        obj.save()
-        data = form.cleaned_data
-        fields = ('headline', 'slug', 'summary', 'body')
-        for l, _ in settings.LANGUAGES:
-            if change:
-                try:
-                    instance = models.PostContent.objects.get(post = obj, language = l)
-                except models.PostContent.DoesNotExist:
+        # un PostContent per lingua, ma il post deve essere pubblicato (email,
+        # twitter) una volta sola
+        with models.coalesce_publishing():
+            obj.save()
+            data = form.cleaned_data
+            fields = ('headline', 'slug', 'summary', 'body')
+            for l, _ in settings.LANGUAGES:
+                if change:
+                    try:
+                        instance = models.PostContent.objects.get(post = obj, language = l)
+                    except models.PostContent.DoesNotExist:
+                        instance = models.PostContent()
+                else:
                     instance = models.PostContent()
-            else:
-                instance = models.PostContent()
-            if not instance.id:
-                instance.post = obj
-                instance.language = l
-            for f in fields:
-                key = f + '_' + l
-                setattr(instance, f, data.get(key, ''))
-            instance.save()
+                if not instance.id:
+                    instance.post = obj
+                    instance.language = l
+                for f in fields:
+                    key = f + '_' + l
+                    setattr(instance, f, data.get(key, ''))
+                instance.save()
 
 admin.site.register(models.Post, PostAdmin)
 
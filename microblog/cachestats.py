@@ -0,0 +1,163 @@
+# -*- coding: UTF-8 -*-
+"""
+Statistiche sull'uso delle cache di dataaccess.
+
+Ogni funzione decorata con cache_me registra, con il proprio nome, queste
+metriche:
+
+    hits          - valori trovati in cache (in uno qualsiasi dei livelli)
+    misses        - valori non trovati
+    computes      - volte in cui il valore è stato ricalcolato
+    compute_time  - millisecondi spesi nel ricalcolo
+    size          - byte (del valore serializzato) dei valori ricalcolati
+    invalidations - invalidazioni ricevute
+
+Le metriche vengono inviate ai sink elencati in MICROBLOG_CACHE_STATS_SINKS.
+"""
+from django.core.cache import cache
+from django.utils.importlib import import_module
+
+from microblog import settings
+
+from collections import defaultdict
+import atexit
+import cPickle as pickle
+import logging
+import socket
+import threading
+import time
+
+log = logging.getLogger('microblog')
+
+METRICS = ('hits', 'misses', 'computes', 'compute_time', 'size', 'invalidations')
+
+# nomi delle funzioni decorate con cache_me
+functions = []
+
+class MemorySink(object):
+    """
+    Tiene le statistiche in memoria, sono visibili solo dal processo che le
+    ha raccolte.
+    """
+    shared = False
+    def __init__(self):
+        self._data = defaultdict(lambda: dict.fromkeys(METRICS, 0))
+        self._lock = threading.Lock()
+
+    def record(self, name, metric, value):
+        with self._lock:
+            self._data[name][metric] += value
+
+    def report(self):
+        with self._lock:
+            return dict((k, dict(v)) for k, v in self._data.items())
+
+    def reset(self):
+        with self._lock:
+            self._data.clear()
+
+class CacheSink(object):
+    """
+    Tiene le statistiche nella cache di django, sono condivise da tutti i
+    processi che usano la stessa cache (e leggibili con il comando
+    microblog_cache_stats).
+
+    Le metriche vengono accumulate in memoria e scritte nella cache al più
+    ogni MICROBLOG_CACHE_STATS_FLUSH secondi, per non aggiungere una
+    richiesta alla cache ad ogni accesso.
+    """
+    timeout = 30 * 24 * 60 * 60
+    shared = True
+
+    def __init__(self):
+        self._pending = defaultdict(int)
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        atexit.register(self.flush)
+
+    def _key(self, name, metric):
+        return 'm:stats:%s:%s' % (name, metric)
+
+    def record(self, name, metric, value):
+        with self._lock:
+            self._pending[(name, metric)] += value
+            if time.time() - self._last_flush < settings.MICROBLOG_CACHE_STATS_FLUSH:
+                return
+            pending = self._pending
+            self._pending = defaultdict(int)
+            self._last_flush = time.time()
+        self._write(pending)
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = defaultdict(int)
+            self._last_flush = time.time()
+        self._write(pending)
+
+    def _write(self, pending):
+        for (name, metric), value in pending.items():
+            if not value:
+                continue
+            k = self._key(name, metric)
+            try:
+                cache.incr(k, value)
+            except ValueError:
+                if not cache.add(k, value, self.timeout):
+                    cache.incr(k, value)
+
+    def report(self):
+        self.flush()
+        keys = dict(((name, metric), self._key(name, metric)) for name in functions for metric in METRICS)
+        values = cache.get_many(keys.values())
+        output = {}
+        for (name, metric), k in keys.items():
+            output.setdefault(name, {})[metric] = values.get(k, 0)
+        return output
+
+    def reset(self):
+        with self._lock:
+            self._pending.clear()
+        cache.delete_many([ self._key(name, metric) for name in functions for metric in METRICS ])
+
+class LoggingSink(object):
+    def record(self, name, metric, value):
+        log.debug('cache %s %s: %s', name, metric, value)
+
+class StatsdSink(object):
+    """
+    Invia le metriche, via UDP, ad un server compatibile con statsd
+    (MICROBLOG_CACHE_STATS_STATSD).
+    """
+    def __init__(self):
+        self.address = settings.MICROBLOG_CACHE_STATS_STATSD
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, name, metric, value):
+        kind = 'ms' if metric == 'compute_time' else 'c'
+        message = 'microblog.cache.%s.%s:%s|%s' % (name, metric, value, kind)
+        try:
+            self._socket.sendto(message, self.address)
+        except socket.error:
+            pass
+
+_sinks = None
+def sinks():
+    global _sinks
+    if _sinks is None:
+        output = []
+        for path in settings.MICROBLOG_CACHE_STATS_SINKS:
+            module, attr = path.rsplit('.', 1)
+            output.append(getattr(import_module(module), attr)())
+        _sinks = output
+    return _sinks
+
+def enabled():
+    return bool(sinks())
+
+def record(name, metric, value=1):
+    for s in sinks():
+        s.record(name, metric, value)
+
+def payload_size(data):
+    return len(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
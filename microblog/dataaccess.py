@@ -1,39 +1,278 @@
 # -*- coding: UTF-8 -*-
 
+from collections import OrderedDict
 from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
 from django.db.models.signals import post_delete, post_save
+import cPickle as pickle
 import functools
 import hashlib
+import marshal
+import math
+import random
+import threading
+import time
+import zlib
+
+from microblog import cachestats
+from microblog import settings
+
+class LRUCache(object):
+    """
+    Cache in memoria, locale al processo, con un numero massimo di elementi e
+    una scadenza (in secondi) per ogni elemento.
+
+    Viene usata come primo livello davanti alla cache di django; i valori
+    restituiti sono condivisi tra tutti i thread del processo e non devono
+    essere modificati.
+    """
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, k):
+        with self._lock:
+            try:
+                expire, value = self._data.pop(k)
+            except KeyError:
+                return None
+            if expire < time.time():
+                return None
+            # reinserendo la chiave la sposto in fondo, tra le più recenti
+            self._data[k] = (expire, value)
+            return value
+
+    def set(self, k, value):
+        with self._lock:
+            self._data.pop(k, None)
+            self._data[k] = (time.time() + self.timeout, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete_many(self, ks):
+        with self._lock:
+            for k in ks:
+                self._data.pop(k, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+# memoizzazione legata alla singola richiesta http; viene attivata dal
+# middleware microblog.middleware.RequestCacheMiddleware
+_request = threading.local()
+
+def request_cache_start():
+    _request.data = {}
+    _request.hits = 0
+    _request.misses = 0
+
+def request_cache_stop():
+    """
+    Disattiva la memoizzazione per il thread corrente e ne restituisce le
+    statistiche.
+    """
+    stats = request_cache_stats()
+    _request.__dict__.clear()
+    return stats
+
+def request_cache_stats():
+    """
+    Restituisce un dict con gli hit e i miss della memoizzazione per la
+    richiesta in corso o None se non è attiva.
+    """
+    if getattr(_request, 'data', None) is None:
+        return None
+    return {
+        'hits': _request.hits,
+        'misses': _request.misses,
+    }
+
+def _msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        raise ImproperlyConfigured('In order to use the msgpack serializer you need the msgpack module')
+    return msgpack.packb, msgpack.unpackb
+
+# serializzatori utilizzabili con cache_me: nome -> funzione che restituisce
+# la coppia (dumps, loads)
+SERIALIZERS = {
+    'pickle': lambda: (lambda o: pickle.dumps(o, pickle.HIGHEST_PROTOCOL), pickle.loads),
+    # marshal e msgpack sono più veloci e compatti ma supportano solo i tipi
+    # base di python
+    'marshal': lambda: (marshal.dumps, marshal.loads),
+    'msgpack': _msgpack,
+}
+
+class Serializer(object):
+    """
+    Converte i valori da salvare in cache in stringhe utilizzando uno dei
+    SERIALIZERS; se `compress` è specificato (il livello di compressione di
+    zlib) le stringhe più lunghe di `compress_min` byte vengono compresse.
+    """
+    def __init__(self, name='pickle', compress=None, compress_min=1024):
+        try:
+            self._dumps, self._loads = SERIALIZERS[name]()
+        except KeyError:
+            raise ImproperlyConfigured('unknown cache serializer "%s"' % name)
+        self.compress = compress
+        self.compress_min = compress_min
+
+    def dumps(self, o):
+        data = self._dumps(o)
+        if self.compress is not None and len(data) > self.compress_min:
+            return 'z' + zlib.compress(data, self.compress)
+        return 'r' + data
+
+    def loads(self, data):
+        if data[0] == 'z':
+            return self._loads(zlib.decompress(data[1:]))
+        return self._loads(data[1:])
 
 WEEK = 7 * 24 * 60 * 60 # 1 week
-def cache_me(key=None, ikey=None, signals=(), models=(), timeout=WEEK):
+
+# fa parte di tutte le chiavi (valori e versioni) di cache_me, va
+# incrementato quando cambia il formato dei valori salvati; i valori del
+# formato precedente non vengono più letti e scadono da soli
+CACHE_SCHEMA = 2
+
+def cache_me(key=None, ikey=None, signals=(), models=(), timeout=WEEK, l1=None,
+        grace=None, early=None, lock_timeout=30, scope=None,
+        serializer=None, compress=None, compress_min=1024):
+    """
+    Decoratore che memorizza nella cache di django il risultato della
+    funzione decorata.
+
+    I valori non vengono mai cancellati dalla cache: ogni funzione ha un
+    numero di versione (salvato anch'esso nella cache) che viene incrementato
+    quando uno dei `models` viene salvato/cancellato o quando viene emesso
+    uno dei `signals`; un valore salvato con una versione diversa da quella
+    attuale non è più valido e verrà sovrascritto o lasciato scadere.
+    Se `scope` è specificato, deve essere una funzione che, ricevuti gli
+    stessi argomenti della funzione decorata, restituisce l'entità (ad
+    esempio l'id di un post) a cui il valore si riferisce; ogni entità ha la
+    sua versione e `ikey` deve restituire, dato il segnale ricevuto, l'entità
+    (o le entità) da invalidare, l'entità None le invalida tutte. Senza
+    `scope`, `ikey` può restituire un valore falso per evitare
+    l'invalidazione.
+    Le versioni vengono lette insieme al valore, con una sola get_many.
+
+    `l1`, se specificato, è il numero massimo di elementi da tenere anche in
+    una LRUCache locale al processo (valida MICROBLOG_CACHE_L1_TIMEOUT
+    secondi); l'invalidazione via segnali svuota anche questo livello, ma
+    solo nel processo che riceve il segnale, gli altri processi vedono il
+    nuovo valore allo scadere della loro copia locale.
+
+    Se la memoizzazione per richiesta è attiva (vedi request_cache_start) i
+    valori vengono prima cercati lì.
+
+    `grace` attiva la protezione contro il ricalcolo contemporaneo dello
+    stesso valore da parte di più processi: il valore resta in cache per
+    altri `grace` secondi dopo la sua scadenza; quando è scaduto (o
+    invalidato) un solo processo, quello che ottiene il lock (valido
+    `lock_timeout` secondi), lo ricalcola mentre gli altri continuano ad
+    usare il vecchio valore. Se il valore non c'è proprio gli altri processi
+    attendono, fino a `lock_timeout` secondi, che venga calcolato.
+    `early` (tipicamente 1.0) anticipa in modo probabilistico il ricalcolo
+    prima della scadenza, tanto più quanto il calcolo è lento.
+
+    `serializer` (uno dei SERIALIZERS) e `compress` (il livello di
+    compressione di zlib, per i valori più lunghi di `compress_min` byte)
+    permettono di scegliere come i valori vengono salvati nella cache
+    condivisa; se non sono specificati il valore viene passato così com'è
+    alla cache di django.
+
+    L'uso della cache viene registrato con il modulo cachestats.
+    """
     def hashme(k):
         if isinstance(k, unicode):
             k = k.encode('utf-8')
-        return hashlib.md5(k).hexdigest()
+        return hashlib.md5('%d|%s' % (CACHE_SCHEMA, k)).hexdigest()
     def decorator(f):
+        if l1 and settings.MICROBLOG_CACHE_L1:
+            local = LRUCache(l1, settings.MICROBLOG_CACHE_L1_TIMEOUT)
+        else:
+            local = None
+        hard_timeout = timeout + (grace or 0)
+        if serializer is not None or compress is not None:
+            codec = Serializer(serializer or 'pickle', compress, compress_min)
+        else:
+            codec = None
+        cachestats.functions.append(f.__name__)
 
-        def invalidate(sender, **kwargs):
-            if ikey is None:
-                ks = (f.__name__,)
-            elif callable(ikey):
-                k = ikey(sender, **kwargs)
-                if isinstance(k, basestring):
-                    ks = (k,)
-                else:
-                    ks = k
+        def _record(metric, value=1):
+            cachestats.record(f.__name__, metric, value)
+
+        def _vkey(entity=None):
+            if entity is None:
+                return hashme('m:v:%s' % f.__name__)
+            return hashme(u'm:v:%s:%s' % (f.__name__, entity))
+
+        def _vkeys(*args, **kwargs):
+            if scope is None:
+                return (_vkey(),)
+            return (_vkey(), _vkey(scope(*args, **kwargs)))
+
+        def _version(vks, values):
+            """
+            Restituisce la versione attuale, `values` è il risultato di una
+            get_many che comprende le chiavi `vks`.
+            """
+            version = []
+            for vk in vks:
+                v = values.get(vk)
+                if v is None:
+                    # una versione nuova (o scaduta) parte da un valore
+                    # diverso da tutti quelli usati in precedenza
+                    v = int(time.time() * 1000)
+                    if not cache.add(vk, v, hard_timeout):
+                        v = cache.get(vk, v)
+                version.append(v)
+            return tuple(version)
+
+        def _bump(vk):
+            try:
+                cache.incr(vk)
+            except ValueError:
+                # la versione non c'è, quando verrà ricreata sarà comunque
+                # diversa dalla precedente
+                pass
+
+        def invalidate(sender=None, entity=None, **kwargs):
+            if sender is None:
+                entities = (entity,)
+            elif ikey is None:
+                entities = (None,)
             else:
-                ks = (ikey,)
-            if ks:
-                cache.delete_many(map(hashme, ks))
+                e = ikey(sender, **kwargs) if callable(ikey) else ikey
+                if not e:
+                    entities = ()
+                elif scope is None:
+                    entities = (None,)
+                elif isinstance(e, (list, tuple, set)):
+                    entities = e
+                else:
+                    entities = (e,)
+            if not entities:
+                return
+            for e in entities:
+                _bump(_vkey(e))
+            _record('invalidations', len(entities))
+            if local is not None:
+                local.clear()
+            store = getattr(_request, 'data', None)
+            if store is not None:
+                store.pop(f.__name__, None)
 
-        if ikey or (ikey is None and key is None):
-            for s in signals:
-                s.connect(invalidate, weak=False)
+        for s in signals:
+            s.connect(invalidate, weak=False)
 
-            for m in models:
-                post_save.connect(invalidate, sender=m, weak=False)
-                post_delete.connect(invalidate, sender=m, weak=False)
+        for m in models:
+            post_save.connect(invalidate, sender=m, weak=False)
+            post_delete.connect(invalidate, sender=m, weak=False)
 
         def _key(*args, **kwargs):
             if key is None:
@@ -44,69 +283,531 @@ def cache_me(key=None, ikey=None, signals=(), models=(), timeout=WEEK):
                 k = key % args
             return hashme(k)
 
+        def _pack(data, delta, version):
+            if codec is not None:
+                data = codec.dumps(data)
+            return (data, time.time() + timeout, delta, version)
+
+        def _unpack(entry, version):
+            """
+            Restituisce il valore salvato e un booleano che indica se è ancora
+            valido.
+            """
+            if not isinstance(entry, tuple) or len(entry) != 4:
+                # nessun valore, o un valore salvato da una versione
+                # precedente di cache_me (senza la busta)
+                return None, False
+            data, expire, delta, v = entry
+            if v != version:
+                valid = False
+            else:
+                now = time.time()
+                if early:
+                    # "XFetch": il ricalcolo viene anticipato di un tempo
+                    # casuale proporzionale al tempo necessario per calcolare
+                    # il valore
+                    now -= delta * early * math.log(1.0 - random.random())
+                valid = now < expire
+            if codec is not None and (valid or grace is not None):
+                data = codec.loads(data)
+            return data, valid
+
+        def _compute(k, version, *args, **kwargs):
+            start = time.time()
+            data = f(*args, **kwargs)
+            elapsed = time.time() - start
+            entry = _pack(data, elapsed, version)
+            cache.set(k, entry, hard_timeout)
+            _record('misses')
+            _record('computes')
+            _record('compute_time', int(elapsed * 1000))
+            if cachestats.enabled():
+                if codec is not None:
+                    _record('size', len(entry[0]))
+                else:
+                    _record('size', cachestats.payload_size(data))
+            return data
+
+        def _shared(k, *args, **kwargs):
+            vks = _vkeys(*args, **kwargs)
+            values = cache.get_many((k,) + vks)
+            version = _version(vks, values)
+            data, valid = _unpack(values.get(k), version)
+            if valid:
+                _record('hits')
+                return data
+            elif grace is None:
+                return _compute(k, version, *args, **kwargs)
+            lock = k + ':lock'
+            if not cache.add(lock, 1, lock_timeout):
+                if data is not None:
+                    _record('hits')
+                    return data
+                # qualcun altro sta calcolando il valore e non ne ho uno
+                # vecchio da usare, aspetto che sia pronto
+                deadline = time.time() + lock_timeout
+                while time.time() < deadline:
+                    time.sleep(0.05)
+                    data, valid = _unpack(cache.get(k), version)
+                    if valid:
+                        _record('hits')
+                        return data
+                return _compute(k, version, *args, **kwargs)
+            try:
+                return _compute(k, version, *args, **kwargs)
+            finally:
+                cache.delete(lock)
+
+        def _get(k, *args, **kwargs):
+            if local is not None:
+                data = local.get(k)
+                if data is not None:
+                    _record('hits')
+                    return data
+            data = _shared(k, *args, **kwargs)
+            if local is not None:
+                local.set(k, data)
+            return data
+
+        def get_many(arglist, versions=None):
+            """
+            Restituisce un dict con i valori presenti in cache tra quelli
+            richiesti; `arglist` è una lista di tuple di argomenti per la
+            funzione decorata, le chiavi del dict restituito sono le tuple per
+            cui è stato trovato un valore.
+
+            Se `versions` è un dict, per le tuple senza un valore valido
+            viene salvata la versione letta insieme ai valori; va passato a
+            set_many insieme ai valori calcolati (vedi set_many).
+            """
+            store = getattr(_request, 'data', None)
+            if store is not None:
+                store = store.setdefault(f.__name__, {})
+            keys = dict((args, _key(*args)) for args in arglist)
+            found = {}
+            missing = []
+            for args, k in keys.items():
+                if store is not None and k in store:
+                    _request.hits += 1
+                    found[args] = store[k]
+                    continue
+                if store is not None:
+                    _request.misses += 1
+                data = local.get(k) if local is not None else None
+                if data is not None:
+                    found[args] = data
+                else:
+                    missing.append(args)
+            if missing:
+                vks = dict((args, _vkeys(*args)) for args in missing)
+                values = cache.get_many(
+                    set(keys[args] for args in missing) | set(sum(vks.values(), ())))
+                for args in missing:
+                    version = _version(vks[args], values)
+                    data, valid = _unpack(values.get(keys[args]), version)
+                    if valid:
+                        found[args] = data
+                        if local is not None:
+                            local.set(keys[args], data)
+                    elif versions is not None:
+                        versions[args] = version
+            if store is not None:
+                for args, data in found.items():
+                    store[keys[args]] = data
+            _record('hits', len(found))
+            _record('misses', len(keys) - len(found))
+            return found
+
+        def versions(arglist):
+            """
+            Restituisce un dict tupla di argomenti -> versione attuale, da
+            leggere prima di calcolare i valori da passare a set_many.
+            """
+            vks = dict((args, _vkeys(*args)) for args in arglist)
+            values = cache.get_many(set(sum(vks.values(), ())))
+            return dict((args, _version(v, values)) for args, v in vks.items())
+
+        def set_many(values, elapsed=None, versions=None):
+            """
+            Salva in cache i valori passati, `values` è un dict tupla di
+            argomenti -> valore; `elapsed`, se specificato, è il tempo (in
+            secondi) speso per calcolare, tutti insieme, i valori.
+
+            `versions` (vedi get_many e versions) contiene le versioni lette
+            prima del calcolo; come in refresh il valore viene salvato con
+            quella versione, se nel frattempo c'è stata un'invalidazione il
+            valore calcolato è già vecchio e non viene salvato.
+            """
+            vks = dict((args, _vkeys(*args)) for args in values)
+            current = cache.get_many(set(sum(vks.values(), ())))
+            delta = elapsed / len(values) if elapsed and values else 0
+            entries = {}
+            fresh = {}
+            for args, data in values.items():
+                version = _version(vks[args], current)
+                if versions is not None and versions.get(args, version) != version:
+                    continue
+                entries[_key(*args)] = _pack(data, delta, version)
+                fresh[args] = data
+            cache.set_many(entries, hard_timeout)
+            if elapsed is not None:
+                _record('computes', len(values))
+                _record('compute_time', int(elapsed * 1000))
+            store = getattr(_request, 'data', None)
+            if store is not None:
+                store = store.setdefault(f.__name__, {})
+            for args, data in fresh.items():
+                k = _key(*args)
+                if local is not None:
+                    local.set(k, data)
+                if store is not None:
+                    store[k] = data
+
+        def refresh(*args, **kwargs):
+            """
+            Ricalcola e salva in cache il valore, anche se è già presente.
+            """
+            k = _key(*args, **kwargs)
+            vks = _vkeys(*args, **kwargs)
+            data = _compute(k, _version(vks, cache.get_many(vks)), *args, **kwargs)
+            if local is not None:
+                local.set(k, data)
+            return data
+
         @functools.wraps(f)
         def wrapper(*args, **kwargs):
             k = _key(*args, **kwargs)
-            data = cache.get(k)
-            if data is None:
-                data = f(*args, **kwargs)
-                cache.set(k, data, timeout)
+            store = getattr(_request, 'data', None)
+            if store is not None:
+                store = store.setdefault(f.__name__, {})
+                try:
+                    data = store[k]
+                except KeyError:
+                    _request.misses += 1
+                else:
+                    _request.hits += 1
+                    _record('hits')
+                    return data
+            data = _get(k, *args, **kwargs)
+            if store is not None:
+                store[k] = data
             return data
         wrapper.cachekey = _key
+        wrapper.get_many = get_many
+        wrapper.set_many = set_many
+        wrapper.versions = versions
+        wrapper.invalidate = invalidate
+        wrapper.refresh = refresh
+        wrapper.l1 = local
             
         return wrapper
     return decorator
 
-from collections import defaultdict
+from array import array
+from collections import defaultdict, namedtuple
+from datetime import date, datetime
 from django.conf import settings as dsettings
 from django.contrib import comments
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 from microblog import models
-from microblog import settings
-from taggit.models import TaggedItem
-
-def _i_post_list(sender, **kw):
-    ks = []
-    for l in dsettings.LANGUAGES:
-        ks.append('m:post_list:%s' % l[0])
-    return ks
-@cache_me(models=(models.Post,),
+from taggit.models import Tag, TaggedItem
+
+def _post_item(item):
+    """
+    True se il TaggedItem passato si riferisce ad un Post.
+    """
+    return item.content_type_id == ContentType.objects.get_for_model(models.Post).id
+
+def _intersect(a, b):
+    """
+    Intersezione di due sequenze ordinate.
+    """
+    output = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] < b[j]:
+            i += 1
+        elif a[i] > b[j]:
+            j += 1
+        else:
+            output.append(a[i])
+            i += 1
+            j += 1
+    return output
+
+class PostList(list):
+    """
+    La lista dei post (ordinata per data decrescente) di una lingua insieme
+    agli indici per anno, categoria, autore e tag; ogni indice associa ad un
+    valore le posizioni, in ordine crescente, dei post corrispondenti.
+    Gli indici vengono salvati in cache insieme alla lista.
+    """
+    def __init__(self, posts, tmap):
+        super(PostList, self).__init__(posts)
+        self.years = defaultdict(lambda: array('I'))
+        self.categories = defaultdict(lambda: array('I'))
+        self.authors = defaultdict(lambda: array('I'))
+        self.tags = defaultdict(lambda: array('I'))
+        for ix, p in enumerate(self):
+            self.years[p.date.year].append(ix)
+            self.categories[p.category.id].append(ix)
+            self.authors[p.author.id].append(ix)
+            for t in tmap.get(p.id, ()):
+                self.tags[t.name.lower()].append(ix)
+        # i defaultdict con una lambda non possono essere serializzati
+        for name in ('years', 'categories', 'authors', 'tags'):
+            setattr(self, name, dict(getattr(self, name)))
+
+    def select(self, year=None, tag=None, category=None, author=None):
+        """
+        Restituisce i post che soddisfano tutti i filtri passati; `category`
+        e `author` sono degli id.
+        """
+        filters = (
+            (self.years, year),
+            (self.tags, tag.lower() if tag is not None else None),
+            (self.categories, category),
+            (self.authors, author),
+        )
+        positions = [ index.get(value, ()) for index, value in filters if value is not None ]
+        if not positions:
+            return list(self)
+        positions.sort(key=len)
+        result = positions[0]
+        for other in positions[1:]:
+            result = _intersect(result, other)
+        return [ self[ix] for ix in result ]
+
+@cache_me(models=(models.PublishedEntry, models.Category, TaggedItem, Tag),
     key='m:post_list:%s',
-    ikey=_i_post_list)
+    l1=len(dsettings.LANGUAGES),
+    grace=60 * 60,
+    early=1.0)
 def post_list(lang):
-    qs = models.Post.objects\
-        .all()\
+    """
+    Restituisce una PostList con i post nella lingua specificata.
+    """
+    qs = models.PublishedEntry.objects\
         .byLanguage(lang)\
-        .order_by('-date')\
-        .select_related('category', 'author')
-    return list(qs)
+        .order_by('-date', '-post')
+    if settings.MICROBLOG_COMPACT_POST_LIST:
+        posts = compact_post_list(qs)
+    else:
+        posts = [ e.post for e in qs.select_related('post__category', 'post__author') ]
+    return PostList(posts, tag_map([ p.id for p in posts ]))
 
-@cache_me(models=(models.Post,))
-def tag_map():
-    tmap = defaultdict(set)
+def _filtered_post_list_key(lang, published, featured=None, year=None, tag=None, category=None, author=None, limit=None):
+    return u'm:filtered_post_list:%s:%s:%s:%s:%s:%s:%s:%s' % (
+        lang, published, featured, year, tag and tag.lower(), category, author, limit)
+@cache_me(models=(models.PublishedEntry, models.Category, TaggedItem, Tag),
+    key=_filtered_post_list_key,
+    l1=100)
+def filtered_post_list(lang, published, featured=None, year=None, tag=None, category=None, author=None, limit=None):
+    """
+    Come post_list ma restituisce solo i post (pubblicati se `published` è
+    True) che soddisfano i filtri passati, al massimo `limit`; `category` e
+    `author` sono degli id. Ogni combinazione di filtri è una query sugli
+    indici di PublishedEntry ed è in cache separatamente.
+    """
+    qs = models.PublishedEntry.objects.byLanguage(lang)
+    if published:
+        qs = qs.published()
+    if featured is not None:
+        qs = qs.filter(featured=featured)
+    if year is not None:
+        qs = qs.filter(date__gte=datetime(year, 1, 1), date__lt=datetime(year + 1, 1, 1))
+    if tag is not None:
+        tagged = TaggedItem.objects\
+            .filter(content_type__app_label='microblog', content_type__model='post')\
+            .filter(tag__name__iexact=tag)\
+            .values('object_id')
+        qs = qs.filter(post__in=tagged)
+    if category is not None:
+        qs = qs.filter(category=category)
+    if author is not None:
+        qs = qs.filter(author=author)
+    qs = qs.order_by('-date', '-post')
+    if limit is not None:
+        qs = qs[:limit]
+    if settings.MICROBLOG_COMPACT_POST_LIST:
+        return compact_post_list(qs)
+    return [ e.post for e in qs.select_related('post__category', 'post__author') ]
+
+def archive_counts(posts):
+    """
+    Conta, con un solo passaggio sulla lista di post passata, i post per
+    anno, mese, autore, categoria e tag; restituisce un dict con le chiavi
+    'years', 'months', 'authors', 'categories' e 'tags' e come valori le
+    liste ordinate delle coppie (chiave, numero di post).
+    """
+    years = defaultdict(lambda: 0)
+    months = defaultdict(lambda: 0)
+    authors = defaultdict(lambda: 0)
+    categories = defaultdict(lambda: 0)
+    tags = defaultdict(lambda: 0)
+    tmap = tag_map([ p.id for p in posts ])
+    for p in posts:
+        years[date(day=1, month=1, year=p.date.year)] += 1
+        months[date(day=1, month=p.date.month, year=p.date.year)] += 1
+        authors[p.author] += 1
+        categories[p.category] += 1
+        for t in tmap.get(p.id, []):
+            tags[t.name] += 1
+    return {
+        'years': sorted(years.items()),
+        'months': sorted(months.items()),
+        'authors': sorted(authors.items(), key=lambda x: x[0].first_name + x[0].last_name),
+        'categories': sorted(categories.items(), key=lambda x: x[0].name),
+        'tags': sorted(tags.items()),
+    }
+
+@cache_me(models=(models.PublishedEntry, models.Category, TaggedItem, Tag),
+    key='m:archive_stats:%s:%s',
+    l1=2 * len(dsettings.LANGUAGES),
+    grace=60 * 60)
+def archive_stats(lang, published):
+    """
+    archive_counts per i post nella lingua specificata, solo quelli
+    pubblicati se `published` è True.
+    """
+    posts = post_list(lang)
+    if published:
+        posts = [ p for p in posts if p.is_published() ]
+    return archive_counts(posts)
+
+class _Record(object):
+    """
+    Mixin per i record di compact_post_list; un record è uguale ad un altro
+    record o ad un'istanza del modello corrispondente con lo stesso id.
+    """
+    __slots__ = ()
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __eq__(self, other):
+        return isinstance(other, (self.__class__, self.model)) and other.pk == self.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+class CategoryRecord(_Record, namedtuple('CategoryRecord', 'id name')):
+    __slots__ = ()
+    model = models.Category
+
+    def __unicode__(self):
+        return self.name
+
+class AuthorRecord(_Record, namedtuple('AuthorRecord', 'id first_name last_name')):
+    __slots__ = ()
+    model = User
+
+    def __unicode__(self):
+        return u'%s %s' % (self.first_name, self.last_name)
+
+class PostRecord(_Record, namedtuple('PostRecord', 'id date featured status category author')):
+    __slots__ = ()
+    model = models.Post
+
+    def is_published(self):
+        return self.status == 'P'
+
+    def get_absolute_url(self):
+        return post_data(self.id, settings.MICROBLOG_DEFAULT_LANGUAGE)['url']
+
+def compact_post_list(qs):
+    """
+    Converte un queryset di PublishedEntry in una lista di PostRecord; i record
+    contengono solo i dati necessari ai template tag che lavorano sulla
+    lista dei post e, rispetto alle istanze dei modelli, occupano molto meno
+    spazio in cache e sono molto più veloci da deserializzare.
+    """
+    fields = (
+        'post_id', 'date', 'featured', 'status',
+        'category_id', 'category__name',
+        'author_id', 'author__first_name', 'author__last_name',
+    )
+    categories = {}
+    authors = {}
+    output = []
+    for row in qs.values_list(*fields):
+        # categorie e autori sono condivisi tra i record, in questo modo
+        # vengono serializzati una volta sola
+        try:
+            category = categories[row[4]]
+        except KeyError:
+            category = categories[row[4]] = CategoryRecord(*row[4:6])
+        try:
+            author = authors[row[6]]
+        except KeyError:
+            author = authors[row[6]] = AuthorRecord(*row[6:9])
+        output.append(PostRecord(row[0], row[1], row[2], row[3], category, author))
+    return output
+
+def _i_post_tags(sender, **kw):
+    if sender is Tag:
+        # il nome di un tag potrebbe essere cambiato
+        return (None,)
+    o = kw['instance']
+    return o.object_id if _post_item(o) else None
+@cache_me(models=(TaggedItem, Tag),
+    key='m:post_tags:%s',
+    ikey=_i_post_tags,
+    scope=lambda pid: pid,
+    l1=500)
+def post_tags(pid):
+    """
+    restituisce i tag del post passato
+    """
     items = TaggedItem.objects\
         .filter(content_type__app_label='microblog', content_type__model='post')\
+        .filter(object_id=pid)\
         .select_related('tag')
-    for o in items:
-        tmap[o.object_id].add(o.tag)
-    return tmap
+    return set(o.tag for o in items)
 
-@cache_me(models=(models.Post,),
-           key = 'm:tagged_posts:%s',
-           ikey = 'm:tagged_posts:%s')
-def tagged_posts(name):
+def tag_map(pids):
     """
-    restituisce i post taggati con il tag passato
+    restituisce un dict pid -> tag per i post passati; i tag di ogni post
+    sono in cache separatamente (vedi post_tags), quelli mancanti vengono
+    recuperati con una sola query.
     """
-    posts = TaggedItem.objects\
+    tmap = defaultdict(set)
+    versions = {}
+    for args, tags in post_tags.get_many([ (pid,) for pid in pids ], versions).items():
+        tmap[args[0]] = tags
+    missing = [ pid for pid in pids if pid not in tmap ]
+    if missing:
+        start = time.time()
+        computed = _post_tags_bulk(missing)
+        post_tags.set_many(
+            dict(((pid,), tags) for pid, tags in computed.items()),
+            elapsed=time.time() - start,
+            versions=versions)
+        tmap.update(computed)
+    return tmap
+
+def _post_tags_bulk(pids):
+    items = TaggedItem.objects\
         .filter(content_type__app_label='microblog', content_type__model='post')\
-        .filter(tag__name__iexact=name)\
-        .values_list('object_id', flat=True)
-    return set(posts)
+        .filter(object_id__in=pids)\
+        .select_related('tag')
+    output = dict((pid, set()) for pid in pids)
+    for o in items:
+        output[o.object_id].add(o.tag)
+    return output
 
 def _i_post_data(sender, **kw):
     if sender is models.Post:
         pid = kw['instance'].id
+    elif sender is TaggedItem:
+        o = kw['instance']
+        pid = o.object_id if _post_item(o) else None
     elif sender is comments.get_model():
         o = kw['instance']
         if o.content_type.app_label == 'microblog' and o.content_type.model == 'post':
@@ -115,14 +816,13 @@ def _i_post_data(sender, **kw):
             pid = None
     else:
         pid = kw['instance'].post_id
-    ks = []
-    if pid:
-        for l in dsettings.LANGUAGES:
-            ks.append('m:post_data:%s%s' % (pid, l[0]))
-    return ks
-@cache_me(models=(models.Post, models.PostContent, comments.get_model()),
+    return pid
+@cache_me(models=(models.Post, models.PostContent, comments.get_model(), TaggedItem),
     key='m:post_data:%s%s',
-    ikey=_i_post_data)
+    ikey=_i_post_data,
+    scope=lambda pid, lang: pid,
+    l1=500,
+    compress=6)
 def post_data(pid, lang):
     post = models.Post.objects\
         .select_related('author', 'category')\
@@ -136,32 +836,103 @@ def post_data(pid, lang):
         .filter(content_type__app_label='microblog', content_type__model='post')\
         .filter(object_pk=pid, is_public=True)
 
+    return _post_data(post, content, list(comment_list), list(post.tags.all()))
+
+def _post_data(post, content, comment_list, tags):
     burl = models.PostContent.build_absolute_url(post, content)
     return {
         'post': post,
         'content': content,
         'url': dsettings.DEFAULT_URL_PREFIX + reverse(burl[0], args=burl[1], kwargs=burl[2]),
-        'comments': list(comment_list),
-        'tags': list(post.tags.all()),
+        'comments': comment_list,
+        'tags': tags,
     }
 
+def post_data_many(pids, lang):
+    """
+    Come post_data ma per più post contemporaneamente; restituisce un dict
+    pid -> dati del post (i post inesistenti vengono ignorati).
+
+    I dati già in cache vengono recuperati con una sola get_many, per gli
+    altri vengono eseguite un numero fisso di query indipendente dal numero
+    di post.
+    """
+    versions = {}
+    found = post_data.get_many([ (pid, lang) for pid in pids ], versions)
+    result = dict((args[0], v) for args, v in found.items())
+    missing = [ pid for pid in pids if pid not in result ]
+    if missing:
+        start = time.time()
+        computed = _post_data_bulk(missing, lang)
+        post_data.set_many(
+            dict(((pid, lang), data) for pid, data in computed.items()),
+            elapsed=time.time() - start,
+            versions=versions)
+        result.update(computed)
+    return result
+
+def _post_data_bulk(pids, lang):
+    posts = models.Post.objects\
+        .select_related('author', 'category')\
+        .in_bulk(pids)
+
+    contents = defaultdict(dict)
+    qs = models.PostContent.objects\
+        .filter(post__in=posts.keys())\
+        .exclude(headline='')
+    for c in qs:
+        c.post = posts[c.post_id]
+        contents[c.post_id][c.language] = c
+
+    comment_map = defaultdict(list)
+    qs = comments.get_model().objects\
+        .filter(content_type__app_label='microblog', content_type__model='post')\
+        .filter(object_pk__in=map(str, posts.keys()), is_public=True)
+    for c in qs:
+        comment_map[int(c.object_pk)].append(c)
+
+    tags = defaultdict(list)
+    qs = TaggedItem.objects\
+        .filter(content_type__app_label='microblog', content_type__model='post')\
+        .filter(object_id__in=posts.keys())\
+        .select_related('tag')
+    for o in qs:
+        tags[o.object_id].append(o.tag)
+
+    output = {}
+    for pid in pids:
+        try:
+            post = posts[int(pid)]
+        except KeyError:
+            continue
+        try:
+            content = models.Post.select_content(contents[post.id], lang=lang, fallback=True)
+        except models.PostContent.DoesNotExist:
+            content = None
+        output[pid] = _post_data(post, content, comment_map[post.id], tags[post.id])
+    return output
+
 def _i_get_reactions(sender, **kw):
     if sender is models.Trackback:
-        return 'm:reaction:%s' % kw['instance'].content_id
+        return kw['instance'].content_id
     else:
-        return 'm:reaction:%s' % kw['instance'].object_id
+        return kw['instance'].object_id
 if settings.MICROBLOG_PINGBACK_SERVER:
     deco = cache_me(models=(models.Trackback,),
         key='m:reactions:%s',
-        ikey=_i_get_reactions)
+        ikey=_i_get_reactions,
+        scope=lambda cid: cid,
+        l1=200)
 else:
     from pingback.models import Pingback
     deco = cache_me(models=(models.Trackback, Pingback),
         key='m:reactions:%s',
-        ikey=_i_get_reactions)
+        ikey=_i_get_reactions,
+        scope=lambda cid: cid,
+        l1=200)
 @deco
 def get_reactions(cid):
-    trackbacks = models.Trackback.objects.filter(content=cid)
+    trackbacks = models.Trackback.objects.filter(content=cid, is_public=True)
     if settings.MICROBLOG_PINGBACK_SERVER:
         from pingback.models import Pingback
         # Purtroppo il metodo pingbacks_for_object vuole un oggetto non un id
@@ -175,3 +946,58 @@ def get_reactions(cid):
         if not hasattr(r, 'excerpt'):
             r.excerpt = r.content
     return reactions
+
+def warm_cache(languages=None, recent=None, threads=1):
+    """
+    Ricalcola le cache di post_list e post_data per le lingue specificate
+    (default: tutte quelle in settings.LANGUAGES); se `recent` è specificato
+    solo gli ultimi `recent` post di ogni lingua vengono considerati per
+    post_data. post_tags (usata da tag_map) viene riempita dal calcolo di
+    post_list, per tutti i post della lista.
+    Le lingue vengono elaborate in parallelo da `threads` thread.
+
+    Restituisce un dict nome funzione -> secondi spesi.
+    """
+    from django.db import connection
+    from multiprocessing.pool import ThreadPool
+
+    if languages is None:
+        languages = [ l for l, _ in dsettings.LANGUAGES ]
+    timings = defaultdict(float)
+    lock = threading.Lock()
+
+    def timed(name, f, *args):
+        start = time.time()
+        try:
+            return f(*args)
+        finally:
+            with lock:
+                timings[name] += time.time() - start
+
+    def warm(lang):
+        try:
+            posts = timed('post_list', post_list.refresh, lang)
+            pids = [ p.id for p in posts[:recent] ]
+            def _data():
+                versions = post_data.versions([ (pid, lang) for pid in pids ])
+                computed = _post_data_bulk(pids, lang)
+                post_data.set_many(
+                    dict(((pid, lang), data) for pid, data in computed.items()),
+                    versions=versions)
+            timed('post_data', _data)
+        finally:
+            # ogni thread apre la sua connessione al db
+            if threads > 1:
+                connection.close()
+
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            pool.map(warm, languages)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for lang in languages:
+            warm(lang)
+    return dict(timings)
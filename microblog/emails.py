@@ -0,0 +1,220 @@
+# -*- coding: UTF-8 -*-
+"""
+Rendering delle email dei post.
+
+render_email trasforma un PostContent nella tripla (oggetto, html, testo)
+da inviare; il risultato è in cache, con una chiave che dipende da tutti i
+campi del contenuto e del suo post, e può essere riusato per gli invii, i
+digest e le anteprime. Le modifiche agli oggetti collegati (categoria,
+autore, tag) invalidano la cache.
+
+send_digests invia, con MICROBLOG_EMAIL_DIGEST, una sola email per
+destinatario con tutti i post che non ha ancora ricevuto.
+"""
+from django.conf import settings as dsettings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.template import Template, Context
+from django.utils.html import escape, strip_tags
+
+from lxml import html
+from lxml.html.clean import Cleaner
+import html2text
+from taggit.models import Tag, TaggedItem
+
+from microblog import models
+from microblog import settings
+from microblog.dataaccess import cache_me
+
+from collections import defaultdict, OrderedDict
+from datetime import datetime, timedelta
+import hashlib
+import logging
+
+log = logging.getLogger('microblog')
+
+_templates = {
+    'subject': Template(settings.MICROBLOG_EMAIL_SUBJECT_TEMPLATE),
+    'body': Template(settings.MICROBLOG_EMAIL_BODY_TEMPLATE),
+    'digest_subject': Template(settings.MICROBLOG_EMAIL_DIGEST_SUBJECT_TEMPLATE),
+}
+
+# dalla doc di lxml:
+# The module lxml.html.clean provides a Cleaner class for cleaning up
+# HTML pages. It supports removing embedded or script content, special
+# tags, CSS style annotations and much more.  Say, you have an evil web
+# page from an untrusted source that contains lots of content that
+# upsets browsers and tries to run evil code on the client side:
+#
+# Noi non dobbiamo proteggerci da codice maligno, ma vista la
+# situazione dei client email, possiamo rimuovere embed, javascript,
+# iframe.; tutte cose che non vengono quasi mai renderizzate per bene
+_cleaner = Cleaner()
+
+def _text_converter():
+    # un HTML2Text accumula il testo prodotto da tutte le chiamate a handle
+    # e non può essere condiviso tra thread, si riusa solo la configurazione
+    h = html2text.HTML2Text()
+    h.ignore_images = True
+    return h
+
+def _field_values(obj):
+    return [ getattr(obj, f.attname) for f in obj._meta.fields ]
+
+def content_hash(content):
+    """
+    Hash di tutti i campi del PostContent e del suo post (e dei template che
+    ne fanno il rendering), cambia ad ogni modifica di uno dei due.
+    """
+    h = hashlib.md5()
+    parts = _field_values(content) + _field_values(content.post) + [
+        settings.MICROBLOG_EMAIL_SUBJECT_TEMPLATE,
+        settings.MICROBLOG_EMAIL_BODY_TEMPLATE,
+        dsettings.DEFAULT_URL_PREFIX,
+    ]
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        elif not isinstance(part, str):
+            part = repr(part)
+        h.update(part)
+        h.update('\0')
+    return h.hexdigest()
+
+def render_html(body):
+    """
+    Prepara, per un client di posta, l'html passato; restituisce la coppia
+    (html, testo).
+    """
+    try:
+        hdoc = html.fromstring(body)
+    except Exception, e:
+        raise ValueError('Cannot parse as html: "%s"' % str(e))
+    hdoc = _cleaner.clean_html(hdoc)
+
+    # rendo tutti i link assoluti, in questo modo funzionano anche in un
+    # client di posta
+    hdoc.make_links_absolute(dsettings.DEFAULT_URL_PREFIX)
+
+    body_html = html.tostring(hdoc)
+
+    # per i client di posta che non supportano l'html ecco una versione in
+    # solo testo
+    body_text = _text_converter().handle(body_html)
+    return body_html, body_text
+
+def _render_email_key(content):
+    return 'm:render_email:%s:%s' % (content.id, content_hash(content))
+
+# i template possono usare anche gli oggetti collegati al post
+@cache_me(models=(models.Category, User, TaggedItem, Tag),
+    key=_render_email_key,
+    l1=50,
+    compress=6)
+def render_email(content):
+    """
+    Restituisce la tripla (oggetto, html, testo) della email che pubblica il
+    PostContent passato.
+    """
+    ctx = Context({
+        'content': content,
+    })
+    subject = strip_tags(_templates['subject'].render(ctx))
+    body_html, body_text = render_html(_templates['body'].render(ctx))
+    return subject, body_html, body_text
+
+def render_digest(contents):
+    """
+    Restituisce la tripla (oggetto, html, testo) della email che raccoglie i
+    PostContent passati, riusando il rendering delle email dei singoli
+    contenuti.
+    """
+    parts = [ render_email(c) for c in contents ]
+    ctx = Context({
+        'contents': contents,
+    })
+    subject = strip_tags(_templates['digest_subject'].render(ctx))
+    body_html = '\n'.join(
+        '<h1>%s</h1>\n%s' % (escape(s), h) for s, h, _ in parts)
+    body_text = '\n\n'.join(
+        '%s\n%s\n\n%s' % (s, '=' * len(s), t) for s, _, t in parts)
+    return subject, body_html, body_text
+
+def period_start(period, now):
+    """
+    L'inizio del periodo ('hourly' o 'daily') che contiene `now`; il
+    periodo è allineato all'ora o al giorno, in questo modo il digest parte
+    una volta per periodo anche se il comando non viene eseguito sempre allo
+    stesso minuto.
+    """
+    now = now.replace(minute=0, second=0, microsecond=0)
+    if period == 'daily':
+        now = now.replace(hour=0)
+    return now
+
+def _digest_contents(posts):
+    """
+    Per ogni post (nell'ordine della lista) il PostContent da inviare: il
+    primo, nell'ordine di settings.LANGUAGES, in una delle
+    MICROBLOG_EMAIL_LANGUAGES.
+    """
+    models.attach_contents(posts)
+    languages = [ l for l, _ in dsettings.LANGUAGES
+        if settings.MICROBLOG_EMAIL_LANGUAGES is None or l in settings.MICROBLOG_EMAIL_LANGUAGES ]
+    output = OrderedDict()
+    for p in posts:
+        contents = p.contents()
+        for l in languages:
+            if l in contents:
+                output[p.id] = contents[l]
+                break
+    return output
+
+def send_digests(days=7, force=False):
+    """
+    Invia ad ogni destinatario una email con i post, pubblicati negli ultimi
+    `days` giorni, che non ha ancora ricevuto; per ogni post inviato viene
+    salvato uno Spam, come per le email dei singoli post. I destinatari che
+    hanno già ricevuto una email nel periodo (l'ora o il giorno) corrente
+    di MICROBLOG_EMAIL_DIGEST vengono saltati, a meno che `force` non sia
+    vero.
+
+    Restituisce il numero di email inviate.
+    """
+    now = datetime.now()
+    recipients = set(settings.MICROBLOG_EMAIL_RECIPIENTS)
+    if not force and settings.MICROBLOG_EMAIL_DIGEST:
+        recent = models.Spam.objects\
+            .filter(method='e', date__gte=period_start(settings.MICROBLOG_EMAIL_DIGEST, now))\
+            .values_list('value', flat=True)
+        recipients -= set(recent)
+    if not recipients:
+        return 0
+
+    posts = models.Post.objects\
+        .published()\
+        .filter(date__gte=now - timedelta(days=days), date__lte=now)\
+        .order_by('date')
+    contents = _digest_contents(list(posts))
+    sent = defaultdict(set)
+    for pid, value in models.Spam.objects.filter(method='e', post__in=contents.keys()).values_list('post', 'value'):
+        sent[value].add(pid)
+
+    # di solito tutti i destinatari devono ricevere gli stessi post, il
+    # digest viene preparato una volta per ogni gruppo di post
+    groups = defaultdict(list)
+    for r in recipients:
+        pids = tuple(pid for pid in contents if pid not in sent[r])
+        if pids:
+            groups[pids].append(r)
+
+    messages = []
+    for pids, group in groups.items():
+        subject, body_html, body_text = render_digest([ contents[pid] for pid in pids ])
+        for r in group:
+            email = mail.EmailMultiAlternatives(subject, body_text, dsettings.DEFAULT_FROM_EMAIL, [r])
+            email.attach_alternative(body_html, 'text/html')
+            messages.append((email, [ models.Spam(post_id=pid, method='e', value=r) for pid in pids ]))
+    log.info('digest of %d posts to %d recipients', len(contents), len(messages))
+    models.send_emails(messages)
+    return len(messages)
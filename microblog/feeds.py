@@ -41,12 +41,15 @@ class LatestPosts(Feed):
     author_link = settings.MICROBLOG_AUTHOR_LINK
 
     def items(self, obj):
-        return models.PostContent.objects\
-                .all()\
-                .filter(language=obj, post__status='P')\
-                .exclude(headline='')\
+        ids = list(models.PublishedEntry.objects\
+                .byLanguage(obj)\
+                .published()\
+                .order_by('-date', '-post')\
+                .values_list('content', flat=True)[:10])
+        contents = models.PostContent.objects\
                 .select_related('post', 'post__author')\
-                .order_by('-post__date')[:10]
+                .in_bulk(ids)
+        return [ contents[i] for i in ids if i in contents ]
 
     def item_title(self, item):
         return item.headline
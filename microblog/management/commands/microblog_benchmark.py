@@ -0,0 +1,219 @@
+# -*- coding: UTF-8 -*-
+from django.conf import settings as dsettings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from microblog import dataaccess
+from microblog import models
+from microblog import settings
+from microblog import spamfilter
+
+from contextlib import contextmanager
+from optparse import make_option
+import cPickle as pickle
+import datetime
+import random
+import time
+
+def _timeit(f, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        f()
+    return (time.time() - start) / repeat
+
+def bench_post_list(command, options):
+    """
+    confronta il formato della lista dei post in cache: istanze di Post e
+    PostRecord (MICROBLOG_COMPACT_POST_LIST)
+    """
+    repeat = options['repeat']
+    for lang, _ in dsettings.LANGUAGES:
+        qs = models.PublishedEntry.objects\
+            .byLanguage(lang)\
+            .order_by('-date', '-post')
+        formats = (
+            ('models', [ e.post for e in qs.select_related('post__category', 'post__author') ]),
+            ('compact', dataaccess.compact_post_list(qs)),
+        )
+        command.stdout.write('%s: %d posts\n' % (lang, len(formats[0][1])))
+        for name, posts in formats:
+            data = pickle.dumps(posts, pickle.HIGHEST_PROTOCOL)
+            elapsed = _timeit(lambda: pickle.loads(data), repeat)
+            command.stdout.write('  %-10s %10d bytes %10.3f ms load\n' % (name, len(data), elapsed * 1000))
+
+def _explain(command, qs):
+    sql, params = qs.query.sql_with_params()
+    if connection.vendor == 'sqlite':
+        sql = 'EXPLAIN QUERY PLAN ' + sql
+    else:
+        sql = 'EXPLAIN ' + sql
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    for row in cursor.fetchall():
+        command.stdout.write('    %s\n' % ' '.join(map(unicode, row)))
+
+@contextmanager
+def _test_db():
+    """
+    esegue il blocco su un database di test, creato per l'occasione e
+    distrutto alla fine; il database reale non viene toccato.
+    """
+    if 'south' in dsettings.INSTALLED_APPS:
+        # come il test runner di south: senza la patch syncdb salterebbe le
+        # app con le migration
+        from south.management.commands import patch_for_test_db_setup
+        patch_for_test_db_setup()
+    name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(name, verbosity=0)
+
+def bench_bylanguage(command, options):
+    """
+    confronta, su un corpus generato di --posts post in tre lingue, il piano
+    e il tempo di esecuzione della vecchia implementazione di byLanguage
+    (con la subquery NOT IN) e di quella attuale; il corpus viene creato in
+    un database di test distrutto alla fine.
+    """
+    languages = ('l1', 'l2', 'l3')
+    with _test_db():
+        # bulk_create non invia i segnali post_save, la cache condivisa non
+        # viene invalidata
+        models.Category.objects.bulk_create([models.Category(name='benchmark')])
+        User.objects.bulk_create([User(username='microblog-benchmark')])
+        category = models.Category.objects.get(name='benchmark')
+        author = User.objects.get(username='microblog-benchmark')
+        now = datetime.datetime.now()
+        batch = 1000
+        for offset in xrange(0, options['posts'], batch):
+            models.Post.objects.bulk_create([
+                models.Post(
+                    date=now - datetime.timedelta(minutes=ix),
+                    author=author,
+                    category=category,
+                    status='P',
+                    allow_comments=False)
+                for ix in xrange(offset, min(offset + batch, options['posts'])) ])
+        pids = models.Post.objects.values_list('id', flat=True)
+        contents = []
+        for ix, pid in enumerate(pids.iterator()):
+            for lang in languages:
+                # un post su dieci non ha la headline nella prima lingua
+                headline = '' if lang == 'l1' and ix % 10 == 0 else 'headline %d' % ix
+                contents.append(models.PostContent(
+                    post_id=pid,
+                    language=lang,
+                    headline=headline,
+                    slug='post-%d' % ix,
+                    summary='',
+                    body=''))
+            if len(contents) >= batch:
+                models.PostContent.objects.bulk_create(contents)
+                contents = []
+        models.PostContent.objects.bulk_create(contents)
+        command.stdout.write('%d posts created\n' % models.Post.objects.count())
+
+        lang = languages[0]
+        old = models.Post.objects\
+            .filter(postcontent__language=lang)\
+            .exclude(id__in=models.Post.objects.filter(postcontent__language=lang, postcontent__headline=''))\
+            .order_by('-date')
+        new = models.Post.objects\
+            .byLanguage(lang)\
+            .order_by('-date')
+        for name, qs in (('old', old), ('new', new)):
+            qs = qs.values_list('id', flat=True)
+            elapsed = _timeit(lambda: list(qs), options['repeat'])
+            command.stdout.write('  %s: %d rows, %.3f ms\n' % (name, len(list(qs)), elapsed * 1000))
+            _explain(command, qs)
+
+_HAM_WORDS = u'python django pycon talk slides conference thanks great post release sprint workshop keynote community venue schedule'.split()
+_SPAM_WORDS = u'cheap pills casino viagra loans free offer click winner bonus replica discount prize crypto'.split()
+
+def _message(rnd, spam):
+    words = _SPAM_WORDS if spam else _HAM_WORDS
+    text = u' '.join(rnd.choice(words) for _ in xrange(rnd.randint(5, 40)))
+    if spam:
+        text += u' http://spam%d.example.com/' % rnd.randint(0, 50)
+    return {
+        'comment_type': 'comment',
+        'comment_content': text,
+        'comment_author': u'user%d' % rnd.randint(0, 1000),
+        'comment_author_email': u'user@%s' % ('spam.example.com' if spam else 'example.org'),
+        'user_ip': '10.%d.%d.%d' % (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)),
+    }
+
+def bench_classifier(command, options):
+    """
+    addestramento e throughput del classificatore antispam locale
+    (spamfilter) su un corpus generato di --messages commenti, metà spam e
+    metà no
+    """
+    rnd = random.Random(0)
+    n = options['messages']
+    samples = [ (_message(rnd, ix % 2 == 0), ix % 2 == 0) for ix in xrange(n) ]
+    train, test = samples[:n // 2], samples[n // 2:]
+
+    start = time.time()
+    c = spamfilter.train(train)
+    command.stdout.write('  train:    %d messages in %.3fs\n' % (len(train), time.time() - start))
+
+    start = time.time()
+    for data, _ in test:
+        spamfilter.features(data)
+    features = time.time() - start
+    feats = [ (spamfilter.features(data), spam) for data, spam in test ]
+    start = time.time()
+    for f, _ in feats:
+        c.spam_probability(f)
+    classify = time.time() - start
+    total = features + classify
+    command.stdout.write('  classify: %.3f ms/message (features %.3f ms), %d messages/s\n' % (
+        total * 1000 / len(test), features * 1000 / len(test), len(test) / total if total else 0))
+
+    threshold = settings.MICROBLOG_BAYES_THRESHOLD
+    correct = sum(1 for f, spam in feats if (c.spam_probability(f) >= threshold) == spam)
+    command.stdout.write('  accuracy: %.1f%%\n' % (100.0 * correct / len(test)))
+
+BENCHMARKS = {
+    'post_list': bench_post_list,
+    'bylanguage': bench_bylanguage,
+    'classifier': bench_classifier,
+}
+
+class Command(BaseCommand):
+    args = 'benchmark [benchmark ...]'
+    help = 'Run the microblog benchmarks: %s' % ', '.join(sorted(BENCHMARKS))
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat',
+            action='store',
+            type='int',
+            dest='repeat',
+            default=100,
+            help='number of repetitions of every measure'),
+        make_option('--posts',
+            action='store',
+            type='int',
+            dest='posts',
+            default=100000,
+            help='number of posts generated by the bylanguage benchmark'),
+        make_option('--messages',
+            action='store',
+            type='int',
+            dest='messages',
+            default=20000,
+            help='number of comments generated by the classifier benchmark'),
+        )
+
+    def handle(self, *args, **options):
+        names = args or sorted(BENCHMARKS)
+        for name in names:
+            try:
+                f = BENCHMARKS[name]
+            except KeyError:
+                raise CommandError('unknown benchmark "%s"' % name)
+            self.stdout.write('== %s\n' % name)
+            f(self, options)
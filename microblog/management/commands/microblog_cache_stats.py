@@ -0,0 +1,44 @@
+# -*- coding: UTF-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from microblog import cachestats
+# importando dataaccess vengono registrate le funzioni in cache
+from microblog import dataaccess
+
+from optparse import make_option
+
+class Command(BaseCommand):
+    help = 'Show the usage statistics of the microblog caches'
+    option_list = BaseCommand.option_list + (
+        make_option('--reset',
+            action='store_true',
+            dest='reset',
+            default=False,
+            help='reset the statistics after showing them'),
+        )
+
+    def handle(self, *args, **options):
+        # le statistiche dei sink non condivisi (MemorySink) appartengono al
+        # processo che le ha raccolte, da qui sarebbero sempre vuote
+        sinks = [ s for s in cachestats.sinks() if getattr(s, 'shared', False) ]
+        if not sinks:
+            raise CommandError('no shared statistics, add microblog.cachestats.CacheSink to MICROBLOG_CACHE_STATS_SINKS')
+
+        for s in sinks:
+            self.stdout.write('%s\n' % s.__class__.__name__)
+            self.stdout.write('%-20s %10s %10s %7s %10s %12s %8s\n' % (
+                'function', 'hits', 'misses', 'ratio', 'avg ms', 'avg bytes', 'inval.'))
+            for name, m in sorted(s.report().items()):
+                total = m['hits'] + m['misses']
+                computes = m['computes'] or 1
+                self.stdout.write('%-20s %10d %10d %6.1f%% %10.1f %12d %8d\n' % (
+                    name,
+                    m['hits'],
+                    m['misses'],
+                    100.0 * m['hits'] / total if total else 0,
+                    float(m['compute_time']) / computes,
+                    m['size'] / computes,
+                    m['invalidations'],
+                ))
+            if options['reset']:
+                s.reset()
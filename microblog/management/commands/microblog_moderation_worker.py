@@ -0,0 +1,39 @@
+# -*- coding: UTF-8 -*-
+from django.core.management.base import BaseCommand
+
+from microblog import moderation
+
+from optparse import make_option
+import time
+
+class Command(BaseCommand):
+    help = 'Check for spam the comments and trackbacks waiting for moderation'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch',
+            action='store',
+            type='int',
+            dest='batch',
+            default=100,
+            help='max number of items checked at once'),
+        make_option('--interval',
+            action='store',
+            type='float',
+            dest='interval',
+            default=10,
+            help='seconds to wait when there is nothing to check'),
+        make_option('--once',
+            action='store_true',
+            dest='once',
+            default=False,
+            help='check the pending items once and exit'),
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            published, spam = moderation.process_pending(limit=options['batch'])
+            if published or spam:
+                self.stdout.write('published %d, spam %d\n' % (published, spam))
+            if options['once']:
+                break
+            if published + spam < options['batch']:
+                time.sleep(options['interval'])
@@ -0,0 +1,48 @@
+# -*- coding: UTF-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from microblog import outbox
+
+from optparse import make_option
+import time
+
+class Command(BaseCommand):
+    help = 'Publish (email, twitter) the posts queued in the outbox'
+    option_list = BaseCommand.option_list + (
+        make_option('--threads',
+            action='store',
+            type='int',
+            dest='threads',
+            default=4,
+            help='number of jobs executed in parallel'),
+        make_option('--batch',
+            action='store',
+            type='int',
+            dest='batch',
+            default=100,
+            help='max number of jobs fetched from the queue at once'),
+        make_option('--interval',
+            action='store',
+            type='float',
+            dest='interval',
+            default=10,
+            help='seconds to wait when the queue is empty'),
+        make_option('--once',
+            action='store_true',
+            dest='once',
+            default=False,
+            help='process the queue once and exit'),
+        )
+
+    def handle(self, *args, **options):
+        if options['threads'] < 1:
+            raise CommandError('--threads must be greater than zero')
+        while True:
+            stats = outbox.process_queue(threads=options['threads'], limit=options['batch'])
+            processed = sum(stats.values())
+            if processed:
+                self.stdout.write('delivered %(delivered)d, failed %(failed)d, skipped %(skipped)d\n' % stats)
+            if options['once']:
+                break
+            if processed < options['batch']:
+                time.sleep(options['interval'])
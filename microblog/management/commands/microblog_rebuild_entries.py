@@ -0,0 +1,13 @@
+# -*- coding: UTF-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from microblog import models
+
+class Command(BaseCommand):
+    help = 'Rebuild the denormalized table used to list the posts'
+
+    def handle(self, *args, **options):
+        with transaction.commit_on_success():
+            count = models.rebuild_published_entries()
+        self.stdout.write('%d entries created\n' % count)
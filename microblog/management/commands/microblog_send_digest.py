@@ -0,0 +1,33 @@
+# -*- coding: UTF-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from microblog import settings
+
+from optparse import make_option
+
+class Command(BaseCommand):
+    help = 'Send the email digest of the posts not yet sent'
+    option_list = BaseCommand.option_list + (
+        make_option('--days',
+            action='store',
+            type='int',
+            dest='days',
+            default=7,
+            help='ignore the posts older than DAYS days'),
+        make_option('--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help='send the digest even to the recipients that received an email in the current period'),
+        )
+
+    def handle(self, *args, **options):
+        if not settings.MICROBLOG_EMAIL_INTEGRATION:
+            raise CommandError('MICROBLOG_EMAIL_INTEGRATION is disabled')
+        if not settings.MICROBLOG_EMAIL_DIGEST and not options['force']:
+            raise CommandError('MICROBLOG_EMAIL_DIGEST is not set, use --force to send a digest anyway')
+        # lxml e html2text servono solo con l'integrazione email
+        from microblog import emails
+
+        sent = emails.send_digests(days=options['days'], force=options['force'])
+        self.stdout.write('%d digests sent\n' % sent)
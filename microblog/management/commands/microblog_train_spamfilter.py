@@ -0,0 +1,21 @@
+# -*- coding: UTF-8 -*-
+from django.core.management.base import BaseCommand
+
+from microblog import settings
+from microblog import spamfilter
+
+import time
+
+class Command(BaseCommand):
+    help = 'Train the local spam classifier with the already moderated comments and trackbacks'
+
+    def handle(self, *args, **options):
+        start = time.time()
+        c = spamfilter.retrain()
+        self.stdout.write('%d spam, %d ham, %d features in %.3fs\n' % (
+            c.docs[True],
+            c.docs[False],
+            len(set(c.counts[True]) | set(c.counts[False])),
+            time.time() - start))
+        if settings.MICROBLOG_BAYES_PATH:
+            self.stdout.write('saved in %s\n' % settings.MICROBLOG_BAYES_PATH)
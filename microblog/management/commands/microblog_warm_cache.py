@@ -0,0 +1,45 @@
+# -*- coding: UTF-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from microblog import dataaccess
+
+from optparse import make_option
+import time
+
+class Command(BaseCommand):
+    help = 'Rebuild the microblog caches'
+    option_list = BaseCommand.option_list + (
+        make_option('--languages',
+            action='store',
+            dest='languages',
+            default=None,
+            help='comma separated list of languages (default: settings.LANGUAGES)'),
+        make_option('--recent',
+            action='store',
+            type='int',
+            dest='recent',
+            default=None,
+            help='warm the post data only for the N most recent posts'),
+        make_option('--threads',
+            action='store',
+            type='int',
+            dest='threads',
+            default=1,
+            help='number of languages processed in parallel'),
+        )
+
+    def handle(self, *args, **options):
+        if options['threads'] < 1:
+            raise CommandError('--threads must be greater than zero')
+        languages = options['languages']
+        if languages:
+            languages = [ l.strip() for l in languages.split(',') ]
+
+        start = time.time()
+        timings = dataaccess.warm_cache(
+            languages=languages,
+            recent=options['recent'],
+            threads=options['threads'])
+        for name, elapsed in sorted(timings.items()):
+            self.stdout.write('%-20s %8.3fs\n' % (name, elapsed))
+        self.stdout.write('%-20s %8.3fs\n' % ('total', time.time() - start))
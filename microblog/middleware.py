@@ -0,0 +1,25 @@
+# -*- coding: UTF-8 -*-
+from django.conf import settings as dsettings
+
+from microblog import dataaccess
+
+import logging
+
+log = logging.getLogger('microblog')
+
+class RequestCacheMiddleware(object):
+    """
+    Memoizza, per la durata della richiesta, i valori restituiti dalle
+    funzioni di dataaccess; i template che chiedono più volte lo stesso
+    post_data lo recuperano (e lo deserializzano) una volta sola.
+    """
+    def process_request(self, request):
+        dataaccess.request_cache_start()
+
+    def process_response(self, request, response):
+        stats = dataaccess.request_cache_stop()
+        if stats is not None:
+            log.debug('request cache for "%s": %d hits, %d misses', request.path, stats['hits'], stats['misses'])
+            if dsettings.DEBUG:
+                response['X-Microblog-Cache'] = 'hits=%(hits)d; misses=%(misses)d' % stats
+        return response
@@ -2,10 +2,11 @@
 from django.conf import settings as dsettings
 from django.contrib.auth.models import User
 from django.core import mail
-from django.db import models
+from django.db import connection, models, transaction
 from django.db.models.query import QuerySet
 from django.db.models.signals import post_save
 from django.template import Template, Context
+from django.template.defaultfilters import slugify
 from django.utils.importlib import import_module
 
 from taggit.managers import TaggableManager
@@ -13,7 +14,13 @@ from taggit.managers import TaggableManager
 from microblog import settings
 from microblog.django_urls import UrlMixin
 
+from collections import defaultdict, namedtuple, OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
 import logging
+import threading
+import time
 
 log = logging.getLogger('microblog')
 
@@ -38,9 +45,24 @@ class PostManager(models.Manager):
 
     class _QuerySet(QuerySet):
         def byLanguage(self, lang):
-            return self\
-                .filter(postcontent__language=lang)\
-                .exclude(id__in=Post.objects.filter(postcontent__language=lang, postcontent__headline=''))
+            """
+            I post con un PostContent, con headline non vuota, nella lingua
+            specificata (in una qualsiasi lingua se lang è None).
+            """
+            # una subquery non correlata su PostContent invece di una join:
+            # niente righe duplicate e quindi niente DISTINCT (che su sqlite
+            # costa un B-TREE temporaneo)
+            contents = PostContent.objects.filter(headline__gt='')
+            if lang is not None:
+                contents = contents.filter(language=lang)
+            return self.filter(id__in=contents.values('post'))
+
+        def with_contents(self):
+            """
+            Precarica i PostContent dei post, Post.content non eseguirà
+            ulteriori query.
+            """
+            return self.prefetch_related('postcontent_set')
 
         def byFeatured(self, featured):
             return self.filter(featured=featured)
@@ -79,8 +101,32 @@ class Post(models.Model, UrlMixin):
         quella del sito, se non esiste viene ritornato il primo PostContent
         esistente, se non esiste neanche questo viene sollevata l'eccezione
         ObjectDoesNotExist.
+
+        Se i PostContent sono stati precaricati (con attach_contents o
+        Post.objects.with_contents()) non viene eseguita nessuna query.
+        """
+        return Post.select_content(self.contents(), lang, fallback)
+
+    def contents(self):
+        """
+        Ritorna un dict lingua -> PostContent con i contenuti (con headline)
+        del post.
+        """
+        try:
+            return self._contents
+        except AttributeError:
+            pass
+        prefetched = getattr(self, '_prefetched_objects_cache', {}).get('postcontent_set')
+        if prefetched is not None:
+            return dict((c.language, c) for c in prefetched if c.headline)
+        return dict((c.language, c) for c in self.postcontent_set.exclude(headline=''))
+
+    @staticmethod
+    def select_content(contents, lang, fallback=True):
+        """
+        Sceglie, tra i PostContent passati (un dict lingua -> PostContent),
+        quello da utilizzare per la lingua specificata; vedi content.
         """
-        contents = dict((c.language, c) for c in self.postcontent_set.exclude(headline=''))
         if not contents:
             raise PostContent.DoesNotExist()
         try:
@@ -117,6 +163,21 @@ class Post(models.Model, UrlMixin):
     def spammed(self, method, value):
         return self.spam_set.filter(method=method, value=value).count() > 0
 
+def attach_contents(posts):
+    """
+    Carica, con una sola query, i PostContent di tutti i post passati; dopo
+    questa chiamata Post.content non esegue più query.
+    """
+    posts = dict((p.id, p) for p in posts)
+    for p in posts.values():
+        p._contents = {}
+    qs = PostContent.objects\
+        .filter(post__in=posts.keys())\
+        .exclude(headline='')
+    for c in qs:
+        c.post = posts[c.post_id]
+        c.post._contents[c.language] = c
+
 SPAM_METHODS = (
     ('e', 'email'),
     ('t', 'twitter'),
@@ -174,6 +235,9 @@ class PostContent(models.Model, UrlMixin):
 
     objects = PostContentManager()
 
+    class Meta:
+        index_together = [['language', 'post']]
+
     @classmethod
     def build_absolute_url(cls, post, content):
         if settings.MICROBLOG_URL_STYLE == 'date':
@@ -201,13 +265,14 @@ class PostContent(models.Model, UrlMixin):
 
     get_url_path = get_absolute_url
 
-    def new_trackback(self, url, blog_name='', title='', excerpt=''):
+    def new_trackback(self, url, blog_name='', title='', excerpt='', is_public=True):
         tb = Trackback()
         tb.content = self
         tb.url = url
         tb.blog_name = blog_name
         tb.title = title
         tb.excerpt = excerpt
+        tb.is_public = is_public
         tb.save()
         return tb
 
@@ -219,144 +284,415 @@ class Trackback(models.Model):
     blog_name = models.TextField()
     title = models.TextField()
     excerpt = models.TextField()
+    is_public = models.BooleanField(default=True)
 
     class Meta:
         ordering = ['-date']
 
-if settings.MICROBLOG_TWITTER_INTEGRATION:
-    import twitter
+MODERATION_TYPES = (
+    ('comment', 'comment'),
+    ('trackback', 'trackback'),
+)
+class ModerationJob(models.Model):
+    """
+    Un commento o trackback salvato come non pubblico in attesa del
+    controllo antispam (vedi MICROBLOG_MODERATION_DEFER e
+    moderation.process_pending); `data` contiene, in json, i dati della
+    richiesta necessari al controllo.
+    """
+    type = models.CharField(max_length=10, choices=MODERATION_TYPES)
+    object_id = models.PositiveIntegerField()
+    data = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
 
-    def truncate_headline(headline, n_char):
-        last = headline[-n_char - 3]
-        headline = headline[:-n_char -3]
-        i = len(headline)
-        while last not in " ,.;:" and i:
-            i -= 1
-            last = headline[i]
-        if i != -1:
-            headline = headline[:i]
-        return headline + "..."
-
-    _twitter_template = Template(settings.MICROBLOG_TWITTER_MESSAGE_TEMPLATE)
-    def post_update_on_twitter(sender, instance, created, **kwargs):
-        if settings.MICROBLOG_TWITTER_LANGUAGES is not None and instance.language not in settings.MICROBLOG_TWITTER_LANGUAGES:
-            return
-        post = instance.post
-        if not post.is_published():
-            return
+    def __unicode__(self):
+        return '%s %s' % (self.type, self.object_id)
 
-        try:
-            if not isinstance(settings.MICROBLOG_TWITTER_POST_URL_MANGLER, str):
-                url = settings.MICROBLOG_TWITTER_POST_URL_MANGLER(instance)
-            else:
-                module, attr = settings.MICROBLOG_TWITTER_POST_URL_MANGLER.rsplit('.', 1)
-                mod = import_module(module)
-                url = getattr(mod, attr)(instance)
-        except Exception, e:
-            message = 'Post: "%s"\n\nCannot retrieve the url: "%s"' % (instance.headline, str(e))
-            mail.mail_admins('[blog] error preparing the tweet', message)
-            return
+def author_slug(user):
+    """
+    Lo slug con cui un utente viene identificato nelle url.
+    """
+    return slugify('%s-%s' % (user.first_name, user.last_name))
 
-        existent = set(( x.value for x in Spam.objects.filter(post=post, method='t') ))
-        recipients = set((settings.MICROBLOG_TWITTER_USERNAME,)) - existent
-        if not recipients:
-            return
+class Author(models.Model):
+    """
+    Lo slug degli autori dei post, permette di trovare un autore partendo
+    dalla url senza scorrere tutti gli utenti; viene creato al salvataggio
+    di un post e aggiornato al salvataggio dell'utente.
+    """
+    user = models.OneToOneField(User)
+    slug = models.SlugField(max_length=100)
+
+    def __unicode__(self):
+        return self.slug
+
+def _update_author_on_post(sender, instance, **kwargs):
+    Author.objects.get_or_create(user_id=instance.author_id, defaults={'slug': author_slug(instance.author)})
+
+def _update_author_on_user(sender, instance, **kwargs):
+    # gli utenti che non hanno scritto post non hanno un Author, non serve
+    # crearlo adesso
+    slug = author_slug(instance)
+    Author.objects.filter(user=instance).exclude(slug=slug).update(slug=slug)
+
+post_save.connect(_update_author_on_post, sender=Post)
+post_save.connect(_update_author_on_user, sender=User)
+
+class PublishedEntryManager(models.Manager):
+    def get_query_set(self):
+        return self._QuerySet(self.model)
+
+    def __getattr__(self, name):
+        return getattr(self.all(), name)
+
+    class _QuerySet(QuerySet):
+        def byLanguage(self, lang):
+            return self.filter(language=lang)
 
+        def published(self):
+            return self.filter(status='P')
+
+class PublishedEntry(models.Model):
+    """
+    Copia denormalizzata dei dati necessari per elencare i post: una riga
+    per ogni post e lingua in cui il post ha un PostContent con headline.
+    Viene aggiornata automaticamente al salvataggio di Post e PostContent
+    (vedi update_published_entries) e può essere ricostruita con il comando
+    microblog_rebuild_entries.
+    """
+    post = models.ForeignKey(Post)
+    content = models.ForeignKey(PostContent)
+    language = models.CharField(max_length = 3)
+    date = models.DateTimeField()
+    status = models.CharField(max_length = 1, choices = POST_STATUS)
+    featured = models.BooleanField(default=False)
+    category = models.ForeignKey(Category)
+    author = models.ForeignKey(User)
+    slug = models.SlugField()
+    headline = models.CharField(max_length = 200)
+
+    objects = PublishedEntryManager()
+
+    class Meta:
+        unique_together = (('post', 'language'),)
+        index_together = [['language', 'status', 'date']]
+
+    def __unicode__(self):
+        return '%s (%s)' % (self.headline, self.language)
+
+def _published_entry(post, content, entry=None):
+    if entry is None:
+        entry = PublishedEntry(post=post, language=content.language)
+    entry.content = content
+    entry.date = post.date
+    entry.status = post.status
+    entry.featured = post.featured
+    entry.category_id = post.category_id
+    entry.author_id = post.author_id
+    entry.slug = content.slug
+    entry.headline = content.headline
+    return entry
+
+def update_published_entries(post):
+    """
+    Allinea le PublishedEntry del post passato ai suoi PostContent.
+    """
+    contents = dict((c.language, c) for c in post.postcontent_set.exclude(headline=''))
+    entries = dict((e.language, e) for e in post.publishedentry_set.all())
+    for lang, content in contents.items():
+        _published_entry(post, content, entries.pop(lang, None)).save()
+    if entries:
+        PublishedEntry.objects.filter(id__in=[ e.id for e in entries.values() ]).delete()
+
+def rebuild_published_entries():
+    """
+    Ricostruisce da zero la tabella delle PublishedEntry.
+    """
+    # bulk_create non invia post_save, le cache che dipendono dalla tabella
+    # vengono invalidate alla fine
+    from microblog import dataaccess
+    PublishedEntry.objects.all().delete()
+    posts = list(Post.objects.all())
+    attach_contents(posts)
+    entries = []
+    for post in posts:
+        for content in post.contents().values():
+            entries.append(_published_entry(post, content))
+    PublishedEntry.objects.bulk_create(entries)
+    for f in (dataaccess.post_list, dataaccess.filtered_post_list, dataaccess.archive_stats):
+        f.invalidate()
+    return len(entries)
+
+def _update_published_entries(sender, instance, **kwargs):
+    if sender is Post:
+        update_published_entries(instance)
+    else:
+        update_published_entries(instance.post)
+
+# la cancellazione di un Post o PostContent cancella, a cascata, anche le
+# PublishedEntry collegate
+post_save.connect(_update_published_entries, sender=Post)
+post_save.connect(_update_published_entries, sender=PostContent)
+
+OUTBOX_STATUS = (
+    ('q', 'In coda'),
+    ('d', 'Consegnato'),
+    ('f', 'Fallito'),
+)
+class OutboxJob(models.Model):
+    """
+    Una pubblicazione (email o twitter) di un PostContent ancora da
+    eseguire; se MICROBLOG_OUTBOX è attivo i segnali di post_save si limitano
+    a creare un OutboxJob, eseguito poi dal comando microblog_outbox_worker
+    (vedi microblog.outbox).
+    """
+    content = models.ForeignKey(PostContent)
+    method = models.CharField(max_length=1, choices=SPAM_METHODS)
+    status = models.CharField(max_length=1, choices=OUTBOX_STATUS, default='q')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField()
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = [['status', 'next_attempt']]
+
+    def __unicode__(self):
+        return '%s -> %s (%s)' % (self.content_id, self.method, self.status)
+
+# i metodi di pubblicazione abilitati, indicizzati per metodo (vedi
+# SPAM_METHODS):
+#   deliver       - esegue la pubblicazione di un PostContent, solleva
+#                   un'eccezione in caso di errore; riceve anche, se già noti,
+#                   i destinatari già raggiunti (i `value` degli Spam)
+#   languages     - le lingue da pubblicare (None per tutte)
+#   error_subject - oggetto dell'email inviata agli amministratori in caso di
+#                   errore
+Publisher = namedtuple('Publisher', 'deliver languages error_subject')
+PUBLISHERS = {}
+
+def _publish(content, method, existent=None):
+    publisher = PUBLISHERS[method]
+    if settings.MICROBLOG_OUTBOX:
+        # un solo job in coda per contenuto e metodo, le consegne già fatte
+        # vengono comunque saltate grazie agli Spam
+        OutboxJob.objects.get_or_create(
+            content=content, method=method, status='q',
+            defaults={'next_attempt': datetime.now()})
+        return
+    try:
+        publisher.deliver(content, existent)
+    except Exception, e:
+        message = 'Post: "%s"\n\n%s' % (content.headline, str(e))
+        mail.mail_admins(publisher.error_subject, message)
+
+def _send_email_batches(messages, size):
+    smtp = mail.get_connection()
+    smtp.open()
+    try:
+        for ix in range(0, len(messages), size):
+            batch = messages[ix:ix+size]
+            start = time.time()
+            # i messaggi vengono passati al backend uno alla volta: se un
+            # invio fallisce gli Spam di quelli già partiti vengono comunque
+            # salvati e un nuovo tentativo non li ripete
+            sent = []
+            try:
+                for m, spam in batch:
+                    if smtp.send_messages([m]):
+                        sent.extend(spam)
+            finally:
+                Spam.objects.bulk_create(sent)
+            elapsed = time.time() - start
+            log.info('%d emails sent in %.2fs (%.1f/s)', len(batch), elapsed, len(batch) / elapsed if elapsed else 0)
+    finally:
+        smtp.close()
+
+def _send_email_batches_thread(args):
+    # ogni thread ha la sua connessione al db
+    try:
+        return _send_email_batches(*args)
+    finally:
+        connection.close()
+
+def send_emails(messages, batch_size=None, connections=None):
+    """
+    Invia una lista di coppie (EmailMessage, [Spam, ...]); i messaggi sono
+    inviati a blocchi di `batch_size` riusando la stessa connessione SMTP e,
+    per ogni blocco, vengono salvati gli Spam dei messaggi inviati (anche se
+    l'invio di un messaggio del blocco è fallito). Con più di una
+    connessione i messaggi sono divisi tra più thread, ognuno con la sua
+    connessione.
+    """
+    if batch_size is None:
+        batch_size = settings.MICROBLOG_EMAIL_BATCH_SIZE
+    if connections is None:
+        connections = settings.MICROBLOG_EMAIL_CONNECTIONS
+    connections = max(1, min(connections, len(messages)))
+    if connections == 1:
+        if messages:
+            _send_email_batches(messages, batch_size)
+        return
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(connections)
+    try:
+        pool.map(_send_email_batches_thread, [ (messages[ix::connections], batch_size) for ix in range(connections) ])
+    finally:
+        pool.close()
+        pool.join()
+
+# le funzioni di consegna sono sempre definite, vengono registrate in
+# PUBLISHERS solo se l'integrazione corrispondente è attiva
+def truncate_headline(headline, n_char):
+    last = headline[-n_char - 3]
+    headline = headline[:-n_char -3]
+    i = len(headline)
+    while last not in " ,.;:" and i:
+        i -= 1
+        last = headline[i]
+    if i != -1:
+        headline = headline[:i]
+    return headline + "..."
+
+_twitter_template = Template(settings.MICROBLOG_TWITTER_MESSAGE_TEMPLATE)
+def deliver_twitter(content, existent=None):
+    post = content.post
+    if existent is None:
+        existent = set(( x.value for x in Spam.objects.filter(post=post, method='t') ))
+    recipients = set((settings.MICROBLOG_TWITTER_USERNAME,)) - existent
+    if not recipients:
+        return
+
+    try:
+        if not isinstance(settings.MICROBLOG_TWITTER_POST_URL_MANGLER, str):
+            url = settings.MICROBLOG_TWITTER_POST_URL_MANGLER(content)
+        else:
+            module, attr = settings.MICROBLOG_TWITTER_POST_URL_MANGLER.rsplit('.', 1)
+            mod = import_module(module)
+            url = getattr(mod, attr)(content)
+    except Exception, e:
+        raise ValueError('Cannot retrieve the url: "%s"' % str(e))
+
+    context = Context({
+        'content': content,
+        'headline': content.headline,
+        'url': url,
+    })
+    status = _twitter_template.render(context)
+    diff_len = len(status) - 140
+    if diff_len > 0:
         context = Context({
-            'content': instance,
-            'headline': instance.headline,
+            'content': content,
+            'headline': truncate_headline(content.headline, diff_len),
             'url': url,
         })
         status = _twitter_template.render(context)
-        diff_len = len(status) - 140
-        if diff_len > 0:
-            context = Context({
-                'content': instance,
-                'headline': truncate_headline(instance.headline, diff_len),
-                'url': url,
-            })
-            status = _twitter_template.render(context)
-        if settings.MICROBLOG_TWITTER_DEBUG:
-            print 'Tweet for', instance.headline.encode('utf-8')
-            print status
-            print '--------------------------------------------'
-            return
-        log.info('"%s" tweet on "%s"', instance.headline.encode('utf-8'), settings.MICROBLOG_TWITTER_USERNAME)
-        try:
-            api = twitter.Api(settings.MICROBLOG_TWITTER_USERNAME, settings.MICROBLOG_TWITTER_PASSWORD)
-            api.PostUpdate(status)
-            s = Spam(post=post, method='t', value=settings.MICROBLOG_TWITTER_USERNAME)
-            s.save()
-        except Exception, e:
-            message = 'Post: "%s"\n\nCannot post status update: "%s"' % (instance.headline, str(e))
-            mail.mail_admins('[blog] error tweeting the new status', message)
-            return
-
-    post_save.connect(post_update_on_twitter, sender=PostContent)
-
-if settings.MICROBLOG_EMAIL_INTEGRATION:
-    _email_templates = {
-        'subject': Template(settings.MICROBLOG_EMAIL_SUBJECT_TEMPLATE),
-        'body': Template(settings.MICROBLOG_EMAIL_BODY_TEMPLATE),
-    }
-    def post_update_on_email(sender, instance, created, **kwargs):
-        if settings.MICROBLOG_EMAIL_LANGUAGES is not None and instance.language not in settings.MICROBLOG_EMAIL_LANGUAGES:
-            return
-        post = instance.post
-        if not post.is_published():
-            return
-
+    if settings.MICROBLOG_TWITTER_DEBUG:
+        print 'Tweet for', content.headline.encode('utf-8')
+        print status
+        print '--------------------------------------------'
+        return
+    log.info('"%s" tweet on "%s"', content.headline.encode('utf-8'), settings.MICROBLOG_TWITTER_USERNAME)
+    api = twitter.Api(settings.MICROBLOG_TWITTER_USERNAME, settings.MICROBLOG_TWITTER_PASSWORD)
+    api.PostUpdate(status)
+    s = Spam(post=post, method='t', value=settings.MICROBLOG_TWITTER_USERNAME)
+    s.save()
+
+def deliver_email(content, existent=None):
+    # import qui per evitare un import circolare (emails -> dataaccess ->
+    # models)
+    from microblog import emails
+
+    post = content.post
+    if existent is None:
         existent = set(( x.value for x in Spam.objects.filter(post=post, method='e') ))
-        recipients = set(settings.MICROBLOG_EMAIL_RECIPIENTS) - existent
-        if not recipients:
-            return
+    recipients = set(settings.MICROBLOG_EMAIL_RECIPIENTS) - existent
+    if not recipients:
+        return
+
+    subject, body_html, body_text = emails.render_email(content)
+    messages = []
+    for r in recipients:
+        email = mail.EmailMultiAlternatives(subject, body_text, dsettings.DEFAULT_FROM_EMAIL, [r])
+        email.attach_alternative(body_html, 'text/html')
+        messages.append((email, [Spam(post=post, method='e', value=r)]))
+    log.info('"%s" email to %d recipients', content.headline.encode('utf-8'), len(messages))
+    send_emails(messages)
 
-        ctx = Context({
-            'content': instance,
-        })
-        from django.utils.html import strip_tags
-        from lxml import html
-        from lxml.html.clean import clean_html
+if settings.MICROBLOG_TWITTER_INTEGRATION:
+    import twitter
 
-        subject = strip_tags(_email_templates['subject'].render(ctx))
-        try:
-            hdoc = html.fromstring(_email_templates['body'].render(ctx))
-        except Exception, e:
-            message = 'Post: "%s"\n\nCannot parse as html: "%s"' % (subject, str(e))
-            mail.mail_admins('[blog] error while sending mail', message)
-            return
-        # dalla doc di lxml:
-        # The module lxml.html.clean provides a Cleaner class for cleaning up
-        # HTML pages. It supports removing embedded or script content, special
-        # tags, CSS style annotations and much more.  Say, you have an evil web
-        # page from an untrusted source that contains lots of content that
-        # upsets browsers and tries to run evil code on the client side:
-        #
-        # Noi non dobbiamo proteggerci da codice maligno, ma vista la
-        # situazione dei client email, possiamo rimuovere embed, javascript,
-        # iframe.; tutte cose che non vengono quasi mai renderizzate per bene
-        hdoc = clean_html(hdoc)
-
-        # rendo tutti i link assoluti, in questo modo funzionano anche in un
-        # client di posta
-        hdoc.make_links_absolute(dsettings.DEFAULT_URL_PREFIX)
-
-        body_html = html.tostring(hdoc)
-
-        # per i client di posta che non supportano l'html ecco una versione in
-        # solo testo
-        import html2text
-        h = html2text.HTML2Text()
-        h.ignore_images = True
-        body_text = h.handle(body_html)
-
-        for r in recipients:
-            log.info('"%s" email to "%s"', instance.headline.encode('utf-8'), r)
-            email = mail.EmailMultiAlternatives(subject, body_text, dsettings.DEFAULT_FROM_EMAIL, [r])
-            email.attach_alternative(body_html, 'text/html')
-            email.send()
-            s = Spam(post=post, method='e', value=r)
-            s.save()
-    post_save.connect(post_update_on_email, sender=PostContent)
+    PUBLISHERS['t'] = Publisher(
+        deliver_twitter,
+        settings.MICROBLOG_TWITTER_LANGUAGES,
+        '[blog] error tweeting the new status')
+
+if settings.MICROBLOG_EMAIL_INTEGRATION:
+    # con i digest (vedi emails.send_digests) le email non vengono inviate
+    # al momento della pubblicazione
+    if settings.MICROBLOG_EMAIL_DIGEST is None:
+        PUBLISHERS['e'] = Publisher(
+            deliver_email,
+            settings.MICROBLOG_EMAIL_LANGUAGES,
+            '[blog] error while sending mail')
+
+def publish_post(contents):
+    """
+    Pubblica, con tutti i metodi abilitati, il post a cui appartengono i
+    PostContent passati (salvati nell'ordine della lista); per ogni metodo
+    viene usato il primo contenuto in una delle lingue da pubblicare.
+    """
+    contents = [ c for c in contents if c.headline ]
+    if not contents or not contents[0].post.is_published():
+        return
+    existent = None
+    if not settings.MICROBLOG_OUTBOX:
+        # lo stato di tutti i metodi con una sola query; con la coda lo
+        # stato viene letto dal worker al momento della consegna
+        existent = defaultdict(set)
+        for method, value in Spam.objects.filter(post=contents[0].post_id).values_list('method', 'value'):
+            existent[method].add(value)
+    for method, publisher in PUBLISHERS.items():
+        for c in contents:
+            if publisher.languages is None or c.language in publisher.languages:
+                _publish(c, method, existent[method] if existent is not None else None)
+                break
+
+_pending = threading.local()
+
+@contextmanager
+def coalesce_publishing():
+    """
+    All'interno del blocco il salvataggio di un PostContent non avvia la
+    pubblicazione del post, che viene eseguita una sola volta all'uscita dal
+    blocco, qualunque sia il numero di contenuti salvati. Se django lo
+    supporta la pubblicazione è rimandata al commit della transazione.
+    """
+    if getattr(_pending, 'posts', None) is not None:
+        # blocco annidato, pubblica quello più esterno
+        yield
+        return
+    _pending.posts = OrderedDict()
+    try:
+        yield
+        posts = _pending.posts
+    finally:
+        _pending.posts = None
+    on_commit = getattr(transaction, 'on_commit', None)
+    for contents in posts.values():
+        if on_commit is not None:
+            on_commit(partial(publish_post, contents))
+        else:
+            publish_post(contents)
+
+def _publish_on_save(sender, instance, **kwargs):
+    posts = getattr(_pending, 'posts', None)
+    if posts is not None:
+        posts.setdefault(instance.post_id, []).append(instance)
+    else:
+        publish_post([instance])
+
+if PUBLISHERS:
+    post_save.connect(_publish_on_save, sender=PostContent)
 
 import moderation
@@ -1,50 +1,213 @@
 # -*- coding: UTF-8 -*-
 from django.conf import settings as dsettings
 from django.core.urlresolvers import reverse
+from django.contrib import comments
 from django.contrib.comments.moderation import CommentModerator, moderator
+from django.contrib.comments.signals import comment_was_posted
 
 from microblog import settings
-from microblog.models import Post
+from microblog.models import ModerationJob, Post, Trackback
+
+import httplib
+import json
+import logging
+import socket
+import threading
+import urllib
+import urlparse
+
+log = logging.getLogger('microblog')
+
+class AkismetError(Exception):
+    pass
+
+class AkismetClient(object):
+    """
+    Client per le API di akismet; la chiave viene verificata una sola volta
+    per processo e ogni thread riusa la sua connessione HTTP (keep-alive)
+    verso `api_url`.
+    """
+    def __init__(self, key, blog_url, api_url):
+        self.key = key
+        self.blog_url = blog_url
+        parts = urlparse.urlsplit(api_url)
+        if parts.scheme == 'https':
+            self._connection_class = httplib.HTTPSConnection
+        else:
+            self._connection_class = httplib.HTTPConnection
+        self.host = parts.netloc
+        self.path = parts.path.rstrip('/')
+        self._local = threading.local()
+        self._verified = None
+
+    def _connection(self):
+        c = getattr(self._local, 'connection', None)
+        if c is None:
+            c = self._connection_class(self.host, timeout=settings.MICROBLOG_AKISMET_TIMEOUT)
+            self._local.connection = c
+        return c
+
+    def _call(self, method, data):
+        body = urllib.urlencode(dict(
+            (k, v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in data.items()))
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'User-Agent': 'Microblog',
+        }
+        # una connessione rimasta aperta può essere stata chiusa dal server,
+        # in questo caso si riprova una volta con una nuova connessione
+        for attempt in (0, 1):
+            c = self._connection()
+            try:
+                c.request('POST', '%s/%s' % (self.path, method), body, headers)
+                response = c.getresponse()
+                # la risposta deve essere letta tutta per poter riusare la
+                # connessione
+                content = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                c.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+        if response.status != 200:
+            raise AkismetError('%s: HTTP %s' % (method, response.status))
+        return content
+
+    def verify_key(self):
+        if self._verified is None:
+            self._verified = self._call('verify-key', {'key': self.key, 'blog': self.blog_url}) == 'valid'
+        return self._verified
+
+    def comment_check(self, data):
+        """
+        Restituisce True se akismet considera spam il commento descritto da
+        `data`.
+        """
+        if not self.verify_key():
+            raise AkismetError('invalid key')
+        data = dict(data, api_key=self.key, blog=self.blog_url)
+        r = self._call('comment-check', data)
+        if r not in ('true', 'false'):
+            raise AkismetError('comment-check: unexpected response "%s"' % r)
+        return r == 'true'
+
+_akismet = None
+_akismet_lock = threading.Lock()
+def akismet_client():
+    global _akismet
+    with _akismet_lock:
+        if _akismet is None:
+            _akismet = AkismetClient(
+                settings.MICROBLOG_AKISMET_KEY,
+                dsettings.DEFAULT_URL_PREFIX + reverse('microblog-full-list'),
+                settings.MICROBLOG_AKISMET_URL)
+        return _akismet
+
+def request_data(request, type, text, user='', email='', url=''):
+    """
+    I dati, estratti dalla richiesta, usati per il controllo antispam.
+    """
+    m = request.META
+    return {
+        'user_ip': m['REMOTE_ADDR'],
+        'user_agent': m.get('HTTP_USER_AGENT', ''),
+        'referrer': m.get('HTTP_REFERER', ''),
+        'comment_type': type,
+        'comment_author': user,
+        'comment_author_email': email,
+        'comment_author_url': url,
+        'comment_content': text,
+        'HTTP_ACCEPT': m.get('HTTP_ACCEPT', ''),
+        'permalink': '',
+        'SERVER_NAME': m.get('SERVER_NAME', ''),
+        'SERVER_SOFTWARE': m.get('SERVER_SOFTWARE', ''),
+        'SERVER_ADMIN': m.get('SERVER_ADMIN', ''),
+        'SERVER_ADDR': m.get('SERVER_ADDR', ''),
+        'SERVER_SIGNATURE': m.get('SERVER_SIGNATURE', ''),
+        'SERVER_PORT': m.get('SERVER_PORT', ''),
+    }
+
+def is_spam(data):
+    if settings.MICROBLOG_MODERATION_TYPE == 'bayes':
+        from microblog import spamfilter
+        return spamfilter.is_spam(data)
+    return akismet_client().comment_check(data)
+
+def deferred():
+    """
+    True se il controllo antispam viene rimandato (vedi defer).
+    """
+    return settings.MICROBLOG_MODERATION_TYPE == 'akismet' and settings.MICROBLOG_MODERATION_DEFER
 
 def moderate(request, type, text, user='', email='', url=''):
-    if settings.MICROBLOG_MODERATION_TYPE == 'akismet':
-        import akismet
-        aks = akismet.Akismet(
-            agent='Microblog',
-            key=settings.MICROBLOG_AKISMET_KEY,
-            blog_url=dsettings.DEFAULT_URL_PREFIX + reverse('microblog-full-list')
-        )
+    """
+    Restituisce True se il commento (o il trackback) deve essere moderato,
+    cioè salvato come non pubblico.
+
+    Se il controllo antispam è rimandato (vedi deferred) restituisce sempre
+    True, l'oggetto una volta salvato deve essere passato a defer.
+    """
+    if settings.MICROBLOG_MODERATION_TYPE in ('akismet', 'bayes'):
+        if deferred():
+            return True
         try:
-            if aks.verify_key():
-                m = request.META
-                data = {
-                    'user_ip': m['REMOTE_ADDR'],
-                    'user_agent': m.get('HTTP_USER_AGENT', ''),
-                    'referrer': m.get('HTTP_REFERER', ''),
-                    'comment_type': type,
-                    'comment_author': user,
-                    'comment_author_email': email,
-                    'comment_author_url': url,
-                    'HTTP_ACCEPT': m.get('HTTP_ACCEPT', ''),
-                    'permalink': '',
-                    'SERVER_NAME': m.get('SERVER_NAME', ''),
-                    'SERVER_SOFTWARE': m.get('SERVER_SOFTWARE', ''),
-                    'SERVER_ADMIN': m.get('SERVER_ADMIN', ''),
-                    'SERVER_ADDR': m.get('SERVER_ADDR', ''),
-                    'SERVER_SIGNATURE': m.get('SERVER_SIGNATURE', ''),
-                    'SERVER_PORT': m.get('SERVER_PORT', ''),
-                }
-                r = aks.comment_check(text.encode('utf-8'), data, build_data=False)
-            else:
-                raise ValueError('Akismet: invalid key')
-        except:
+            return is_spam(request_data(request, type, text, user=user, email=email, url=url))
+        except Exception:
             if dsettings.DEBUG:
                 raise
+            log.exception('spam check failed')
+            return False
     elif settings.MICROBLOG_MODERATION_TYPE == 'always':
         return True
     else:
         return False
 
+def defer(request, type, obj, text, user='', email='', url=''):
+    """
+    Mette in coda il controllo antispam di `obj` (salvato come non
+    pubblico); il controllo viene eseguito da process_pending.
+    """
+    ModerationJob.objects.create(
+        type=type,
+        object_id=obj.id,
+        data=json.dumps(request_data(request, type, text, user=user, email=email, url=url)))
+
+def process_pending(limit=None):
+    """
+    Esegue il controllo antispam dei commenti e trackback in coda, quelli
+    che lo superano vengono resi pubblici; i controlli che falliscono (ad
+    esempio per un errore di rete) vengono ritentati alla chiamata
+    successiva.
+
+    Restituisce la coppia (pubblicati, spam).
+    """
+    jobs = ModerationJob.objects.order_by('id')
+    if limit:
+        jobs = jobs[:limit]
+    published = spam = 0
+    for job in jobs:
+        try:
+            r = is_spam(json.loads(job.data))
+        except Exception:
+            log.exception('spam check of %s failed', job)
+            continue
+        if r:
+            spam += 1
+        else:
+            model = comments.get_model() if job.type == 'comment' else Trackback
+            try:
+                obj = model.objects.get(id=job.object_id)
+            except model.DoesNotExist:
+                pass
+            else:
+                # save (e non update) per invalidare le cache
+                obj.is_public = True
+                obj.save()
+            published += 1
+        job.delete()
+    return published, spam
+
 class PostModeration(CommentModerator):
     email_notification = True
     enable_field = 'allow_comments'
@@ -55,7 +218,16 @@ class PostModeration(CommentModerator):
         r = super(PostModeration, self).moderate(comment, content_object, request)
         if not r:
             r = moderate(request, 'comment', comment.comment, user=comment.user_name, email=comment.user_email, url=comment.user_url)
+            if r and deferred():
+                # il commento non è ancora stato salvato, viene messo in coda
+                # da _defer_comment
+                comment._microblog_deferred = True
         return r
 
+def _defer_comment(sender, comment, request, **kwargs):
+    if getattr(comment, '_microblog_deferred', False):
+        defer(request, 'comment', comment, comment.comment, user=comment.user_name, email=comment.user_email, url=comment.user_url)
+
 if settings.MICROBLOG_MODERATION_TYPE:
     moderator.register(Post, PostModeration)
+    comment_was_posted.connect(_defer_comment)
@@ -0,0 +1,159 @@
+# -*- coding: UTF-8 -*-
+"""
+Coda delle pubblicazioni (email, twitter) dei post.
+
+Con MICROBLOG_OUTBOX attivo il salvataggio di un PostContent non contatta
+né il server SMTP né twitter ma crea un OutboxJob; i job vengono eseguiti
+dal comando microblog_outbox_worker.
+
+Un job fallito viene ritentato dopo MICROBLOG_OUTBOX_RETRY_DELAY secondi,
+raddoppiati ad ogni tentativo, fino a MICROBLOG_OUTBOX_MAX_ATTEMPTS
+tentativi; dopo l'ultimo gli amministratori vengono avvisati via email. Le
+consegne riuscite sono registrate come Spam, quindi un job ritentato non le
+ripete.
+
+Un worker prenota il job per MICROBLOG_OUTBOX_LEASE secondi e rinnova la
+prenotazione finché la consegna è in corso: un altro worker riprende il job
+solo se il primo è morto.
+"""
+from django.core import mail
+from django.db import connection
+
+from microblog import models
+from microblog import settings
+
+from datetime import datetime, timedelta
+import logging
+import threading
+import traceback
+
+log = logging.getLogger('microblog')
+
+def due_jobs(limit=None):
+    """
+    I job in coda che devono essere eseguiti, dal più vecchio.
+    """
+    qs = models.OutboxJob.objects\
+        .filter(status='q', next_attempt__lte=datetime.now())\
+        .select_related('content__post')\
+        .order_by('next_attempt')
+    if limit:
+        qs = qs[:limit]
+    return list(qs)
+
+def _claim(job):
+    """
+    Prenota il job per MICROBLOG_OUTBOX_LEASE secondi, restituisce False se
+    il job è già stato preso da un altro worker. Se il worker muore il job
+    torna disponibile allo scadere della prenotazione.
+    """
+    lease = datetime.now() + timedelta(seconds=settings.MICROBLOG_OUTBOX_LEASE)
+    claimed = models.OutboxJob.objects\
+        .filter(id=job.id, status='q', attempts=job.attempts)\
+        .update(next_attempt=lease, attempts=job.attempts + 1)
+    if claimed:
+        job.attempts += 1
+        job.next_attempt = lease
+    return bool(claimed)
+
+def _renew(job):
+    """
+    Prolunga la prenotazione del job, restituisce False se il job non è più
+    prenotato da questo worker.
+    """
+    lease = datetime.now() + timedelta(seconds=settings.MICROBLOG_OUTBOX_LEASE)
+    renewed = models.OutboxJob.objects\
+        .filter(id=job.id, status='q', attempts=job.attempts)\
+        .update(next_attempt=lease)
+    return bool(renewed)
+
+class _LeaseKeeper(threading.Thread):
+    """
+    Rinnova la prenotazione di un job, ogni terzo di MICROBLOG_OUTBOX_LEASE,
+    fino alla chiamata di stop.
+    """
+    def __init__(self, job):
+        super(_LeaseKeeper, self).__init__()
+        self.daemon = True
+        self.job = job
+        self._stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stopped.wait(settings.MICROBLOG_OUTBOX_LEASE / 3.0):
+                try:
+                    if not _renew(self.job):
+                        log.warning('outbox job %s: lease lost', self.job.id)
+                        return
+                except Exception:
+                    log.exception('outbox job %s: lease renewal failed', self.job.id)
+        finally:
+            # il thread ha la sua connessione al db
+            connection.close()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+def run_job(job):
+    """
+    Esegue il job; restituisce True se la pubblicazione è riuscita, False se
+    è fallita e None se il job è stato preso da un altro worker.
+    """
+    if not _claim(job):
+        return None
+    keeper = _LeaseKeeper(job)
+    keeper.start()
+    try:
+        try:
+            models.PUBLISHERS[job.method].deliver(job.content)
+        finally:
+            keeper.stop()
+    except Exception:
+        job.last_error = traceback.format_exc()
+        if job.attempts >= settings.MICROBLOG_OUTBOX_MAX_ATTEMPTS:
+            job.status = 'f'
+            log.error('outbox job %s failed after %d attempts', job.id, job.attempts)
+            message = 'Post: "%s"\n\nMethod: %s\nAttempts: %d\n\n%s' % (
+                job.content.headline, job.get_method_display(), job.attempts, job.last_error)
+            mail.mail_admins('[blog] error publishing the post', message)
+        else:
+            delay = settings.MICROBLOG_OUTBOX_RETRY_DELAY * 2 ** (job.attempts - 1)
+            job.next_attempt = datetime.now() + timedelta(seconds=delay)
+            log.warning('outbox job %s failed, retry in %ds', job.id, delay)
+        job.save()
+        return False
+    job.status = 'd'
+    job.last_error = ''
+    job.save()
+    return True
+
+def _run_job_thread(job):
+    # ogni thread ha la sua connessione al db
+    try:
+        return run_job(job)
+    finally:
+        connection.close()
+
+def process_queue(threads=1, limit=None):
+    """
+    Esegue i job in scadenza usando `threads` thread; restituisce quanti job
+    sono stati consegnati, quanti sono falliti e quanti sono stati saltati
+    perché presi da un altro worker.
+    """
+    jobs = due_jobs(limit)
+    if threads > 1 and len(jobs) > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads)
+        try:
+            results = pool.map(_run_job_thread, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(run_job, jobs)
+    return {
+        'delivered': results.count(True),
+        'failed': results.count(False),
+        'skipped': results.count(None),
+    }
@@ -0,0 +1,159 @@
+# -*- coding: UTF-8 -*-
+"""
+Paginazione "a cursore" delle liste di post.
+
+Invece di un numero di pagina (che si traduce in COUNT(*) + OFFSET) ogni
+pagina restituisce dei cursori opachi che identificano (data, id) del primo
+e dell'ultimo post; la pagina successiva parte dal post che segue il cursore
+e costa come la prima, qualunque sia la sua posizione.
+
+Le liste devono essere ordinate per data e id decrescenti.
+"""
+from django.conf import settings as dsettings
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.utils import timezone
+
+import base64
+import calendar
+import datetime
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def _timestamp(date):
+    """
+    La data come microsecondi dall'epoch (UTC per le date con timezone), il
+    cursore non dipende dal fuso orario di chi lo ha creato.
+    """
+    return calendar.timegm(date.utctimetuple()) * 1000000 + date.microsecond
+
+def _from_timestamp(ts):
+    date = _EPOCH + datetime.timedelta(microseconds=ts)
+    if dsettings.USE_TZ:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+def encode_cursor(direction, post):
+    raw = '%s|%d|%s' % (direction, _timestamp(post.date), post.id)
+    return base64.urlsafe_b64encode(raw)
+
+def decode_cursor(cursor):
+    """
+    Restituisce la tupla (direzione, data, id) codificata nel cursore o None
+    se il cursore non è valido.
+    """
+    try:
+        direction, date, pid = base64.urlsafe_b64decode(str(cursor)).split('|')
+        date = _from_timestamp(int(date))
+        pid = int(pid)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    if direction not in ('n', 'p'):
+        return None
+    return direction, date, pid
+
+class SeekPage(list):
+    """
+    Una pagina di post; `next_cursor` e `previous_cursor` sono None se non
+    esiste una pagina successiva/precedente, `count` (il numero totale di
+    post) è None se non è stato richiesto.
+    """
+    def __init__(self, items, next_cursor=None, previous_cursor=None, count=None):
+        super(SeekPage, self).__init__(items)
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.count = count
+
+    # compatibilità con django.core.paginator.Page
+    @property
+    def object_list(self):
+        return self
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+def _first_after(items, date, pid):
+    """
+    Ricerca binaria, in una sequenza ordinata per (data, id) decrescente, del
+    primo elemento che segue (date, pid).
+    """
+    lo, hi = 0, len(items)
+    key = (date, pid)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if (items[mid].date, items[mid].id) < key:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+def _first_not_before(items, date, pid):
+    lo, hi = 0, len(items)
+    key = (date, pid)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if (items[mid].date, items[mid].id) <= key:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+def _seek_sequence(items, cursor, count):
+    if cursor is None:
+        start = 0
+    elif cursor[0] == 'n':
+        start = _first_after(items, cursor[1], cursor[2])
+    else:
+        start = max(0, _first_not_before(items, cursor[1], cursor[2]) - count)
+    page = items[start:start + count]
+    has_next = start + count < len(items)
+    has_previous = start > 0
+    return page, has_next, has_previous
+
+def _seek_queryset(qs, cursor, count):
+    if cursor is None or cursor[0] == 'n':
+        qs = qs.order_by('-date', '-id')
+        if cursor is not None:
+            qs = qs.filter(Q(date__lt=cursor[1]) | Q(date=cursor[1], id__lt=cursor[2]))
+        page = list(qs[:count + 1])
+        has_next = len(page) > count
+        page = page[:count]
+        has_previous = cursor is not None
+    else:
+        qs = qs\
+            .order_by('date', 'id')\
+            .filter(Q(date__gt=cursor[1]) | Q(date=cursor[1], id__gt=cursor[2]))
+        page = list(qs[:count + 1])
+        has_previous = len(page) > count
+        page = page[:count]
+        page.reverse()
+        has_next = True
+    return page, has_next, has_previous
+
+def seek(posts, cursor=None, count=20, with_count=False):
+    """
+    Restituisce la SeekPage di `count` post che segue (o precede) il
+    cursore; `posts` può essere un QuerySet o una lista (già ordinata) di
+    oggetti con gli attributi `date` e `id`. Un cursore vuoto o non valido
+    restituisce la prima pagina.
+    """
+    if cursor:
+        cursor = decode_cursor(cursor)
+    else:
+        cursor = None
+    if isinstance(posts, QuerySet):
+        page, has_next, has_previous = _seek_queryset(posts, cursor, count)
+        total = posts.count() if with_count else None
+    else:
+        page, has_next, has_previous = _seek_sequence(posts, cursor, count)
+        total = len(posts) if with_count else None
+    if not page:
+        return SeekPage([], count=total)
+    return SeekPage(
+        page,
+        next_cursor=encode_cursor('n', page[-1]) if has_next else None,
+        previous_cursor=encode_cursor('p', page[0]) if has_previous else None,
+        count=total)
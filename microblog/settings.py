@@ -36,16 +36,26 @@ MICROBLOG_AUTHOR_LINK = getattr(settings, 'MICROBLOG_AUTHOR_LINK', None)
 # None - moderation disabled
 # light - auto moderate comments after 30 days and sends email 
 # akismet - light + akismet validation
+# bayes - light + local spam classifier (see microblog.spamfilter)
 # always - always moderate
 MICROBLOG_MODERATION_TYPE = getattr(settings, 'MICROBLOG_MODERATION_TYPE', 'light')
 MICROBLOG_AKISMET_KEY = getattr(settings, 'MICROBLOG_AKISMET_KEY', None)
 if MICROBLOG_MODERATION_TYPE == 'akismet' and not MICROBLOG_AKISMET_KEY:
     raise ImproperlyConfigured('please set your akismet key')
-elif MICROBLOG_AKISMET_KEY:
-    try:
-        import akismet
-    except ImportError:
-        raise ImproperlyConfigured('In order to use the akismet service you need the akismet module')
+# ... endpoint and timeout (seconds) of the akismet API
+MICROBLOG_AKISMET_URL = getattr(settings, 'MICROBLOG_AKISMET_URL', 'http://rest.akismet.com/1.1/')
+MICROBLOG_AKISMET_TIMEOUT = getattr(settings, 'MICROBLOG_AKISMET_TIMEOUT', 10)
+# ... save the comments and trackbacks as not public and check them later,
+# with the microblog_moderation_worker command, instead of waiting for
+# akismet during the request
+MICROBLOG_MODERATION_DEFER = getattr(settings, 'MICROBLOG_MODERATION_DEFER', False)
+# ... where the bayes classifier is saved by the microblog_train_spamfilter
+# command (until then no comment is considered spam), and the spam
+# probability over which a comment is moderated
+MICROBLOG_BAYES_PATH = getattr(settings, 'MICROBLOG_BAYES_PATH', None)
+if MICROBLOG_MODERATION_TYPE == 'bayes' and not MICROBLOG_BAYES_PATH:
+    raise ImproperlyConfigured('please set MICROBLOG_BAYES_PATH')
+MICROBLOG_BAYES_THRESHOLD = getattr(settings, 'MICROBLOG_BAYES_THRESHOLD', 0.9)
 
 if hasattr(settings, 'MICROBLOG_ENABLE_MODERATION'):
     print 'warning, MICROBLOG_ENABLE_MODERATION is deprecated, use MICROBLOG_MODERATION_TYPE instead'
@@ -64,6 +74,17 @@ MICROBLOG_EMAIL_RECIPIENTS = getattr(settings, 'MICROBLOG_EMAIL_RECIPIENTS', [])
 MICROBLOG_EMAIL_LANGUAGES = getattr(settings, 'MICROBLOG_EMAIL_LANGUAGES', None)
 MICROBLOG_EMAIL_BODY_TEMPLATE = getattr(settings, 'MICROBLOG_EMAIL_BODY_TEMPLATE', '{% if content.summary %}{{ content.summary|safe }}\n{% endif %}{{ content.body|safe }}')
 MICROBLOG_EMAIL_SUBJECT_TEMPLATE = getattr(settings, 'MICROBLOG_EMAIL_SUBJECT_TEMPLATE', '{{ content.headline|safe }}')
+# ... number of emails sent through the same SMTP connection before recording
+# them as sent
+MICROBLOG_EMAIL_BATCH_SIZE = getattr(settings, 'MICROBLOG_EMAIL_BATCH_SIZE', 100)
+# ... number of SMTP connections used in parallel
+MICROBLOG_EMAIL_CONNECTIONS = getattr(settings, 'MICROBLOG_EMAIL_CONNECTIONS', 1)
+# ... send, instead of one email per post, a periodic digest ('hourly' or
+# 'daily') with the posts not yet sent; the digests are sent by the
+# microblog_send_digest command, that must be run at least once per period
+MICROBLOG_EMAIL_DIGEST = getattr(settings, 'MICROBLOG_EMAIL_DIGEST', None)
+assert MICROBLOG_EMAIL_DIGEST in (None, 'hourly', 'daily'), "MICROBLOG_EMAIL_DIGEST should be None, hourly or daily"
+MICROBLOG_EMAIL_DIGEST_SUBJECT_TEMPLATE = getattr(settings, 'MICROBLOG_EMAIL_DIGEST_SUBJECT_TEMPLATE', '{{ contents|length }} new post{{ contents|length|pluralize }}')
 # Microblog twitter integration configuration
 
 # Enable Twitter integration
@@ -80,6 +101,17 @@ MICROBLOG_TWITTER_MESSAGE_TEMPLATE = getattr(settings, 'MICROBLOG_TWITTER_MESSAG
 # ... callable to obtain the url of a post 
 MICROBLOG_TWITTER_POST_URL_MANGLER = getattr(settings, 'MICROBLOG_TWITTER_POST_URL_MANGLER', lambda p: p.get_url())
 
+# Publish the posts (email, twitter) in background: saving a post only queues
+# the work, executed by the microblog_outbox_worker command
+MICROBLOG_OUTBOX = getattr(settings, 'MICROBLOG_OUTBOX', False)
+# ... a failed job is retried after MICROBLOG_OUTBOX_RETRY_DELAY seconds,
+# doubled on every attempt, up to MICROBLOG_OUTBOX_MAX_ATTEMPTS attempts
+MICROBLOG_OUTBOX_MAX_ATTEMPTS = getattr(settings, 'MICROBLOG_OUTBOX_MAX_ATTEMPTS', 5)
+MICROBLOG_OUTBOX_RETRY_DELAY = getattr(settings, 'MICROBLOG_OUTBOX_RETRY_DELAY', 60)
+# ... seconds a worker can hold a job; if the worker dies the job is picked up
+# again after this time
+MICROBLOG_OUTBOX_LEASE = getattr(settings, 'MICROBLOG_OUTBOX_LEASE', 600)
+
 # In order to use bitly as url shortening service set your credentials and use
 # 'microblog.utils.bitly_url' as MICROBLOG_TWITTER_POST_URL_MANGLER
 MICROBLOG_BITLY_LOGIN = getattr(settings, 'MICROBLOG_BITLY_LOGIN', None)
@@ -88,6 +120,13 @@ MICROBLOG_BITLY_APIKEY = getattr(settings, 'MICROBLOG_BITLY_APIKEY', None)
 # Enable the pagination for posts in the post list pages
 MICROBLOG_POST_LIST_PAGINATION = getattr(settings, 'MICROBLOG_POST_LIST_PAGINATION', False)
 
+# Pagination mode: 'offset' uses the django Paginator (a page number),
+# 'seek' uses opaque cursors and makes every page as fast as the first one
+MICROBLOG_POST_LIST_PAGINATION_MODE = getattr(settings, 'MICROBLOG_POST_LIST_PAGINATION_MODE', 'offset')
+assert MICROBLOG_POST_LIST_PAGINATION_MODE in ('offset', 'seek'), "MICROBLOG_POST_LIST_PAGINATION_MODE should be either offset or seek"
+# ... count the posts (one more query) in 'seek' mode
+MICROBLOG_POST_LIST_PAGINATION_COUNT = getattr(settings, 'MICROBLOG_POST_LIST_PAGINATION_COUNT', False)
+
 # Number of post in a single page
 MICROBLOG_POST_PER_PAGE = getattr(settings, 'MICROBLOG_POST_PER_PAGE', 20)
 if MICROBLOG_POST_LIST_PAGINATION and MICROBLOG_POST_PER_PAGE < 1:
@@ -100,4 +139,30 @@ def MICROBLOG_POST_FILTER(posts, user):
         return posts
     else:
         return filter(lambda x: x.is_published(), posts)
+_DEFAULT_POST_FILTER = MICROBLOG_POST_FILTER
 MICROBLOG_POST_FILTER = getattr(settings, 'MICROBLOG_POST_FILTER', MICROBLOG_POST_FILTER)
+# with the default filter the visibility of the posts can be checked directly
+# in the database queries
+MICROBLOG_POST_FILTER_IS_DEFAULT = MICROBLOG_POST_FILTER is _DEFAULT_POST_FILTER
+
+# Enable the per-process LRU cache in front of the django cache for the
+# functions in dataaccess; the entries expire after MICROBLOG_CACHE_L1_TIMEOUT
+# seconds, changes made by other processes are seen at most this late.
+MICROBLOG_CACHE_L1 = getattr(settings, 'MICROBLOG_CACHE_L1', True)
+MICROBLOG_CACHE_L1_TIMEOUT = getattr(settings, 'MICROBLOG_CACHE_L1_TIMEOUT', 60)
+
+# Where to send the usage statistics of the dataaccess caches (see
+# microblog.cachestats); for example:
+#   ['microblog.cachestats.CacheSink'] to share them between processes and
+#   read them with the microblog_cache_stats command
+#   ['microblog.cachestats.StatsdSink'] to send them to a statsd server
+MICROBLOG_CACHE_STATS_SINKS = getattr(settings, 'MICROBLOG_CACHE_STATS_SINKS', [])
+MICROBLOG_CACHE_STATS_STATSD = getattr(settings, 'MICROBLOG_CACHE_STATS_STATSD', ('127.0.0.1', 8125))
+# ... seconds the CacheSink keeps the statistics in memory before writing them
+# to the cache
+MICROBLOG_CACHE_STATS_FLUSH = getattr(settings, 'MICROBLOG_CACHE_STATS_FLUSH', 10)
+
+# Cache the post list as compact records (see dataaccess.compact_post_list)
+# instead of Post instances; the records are much smaller and faster to load,
+# but they have only the attributes needed by the microblog template tags.
+MICROBLOG_COMPACT_POST_LIST = getattr(settings, 'MICROBLOG_COMPACT_POST_LIST', False)
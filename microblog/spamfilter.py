@@ -0,0 +1,187 @@
+# -*- coding: UTF-8 -*-
+"""
+Classificatore antispam locale (MICROBLOG_MODERATION_TYPE = 'bayes').
+
+Un classificatore naive bayes sulle caratteristiche (parole, domini delle
+url, indirizzo ip, ...) di commenti e trackback, addestrato con quelli già
+moderati: i commenti e i trackback pubblici sono ham, i commenti rimossi
+sono spam. I commenti e i trackback non pubblici sono esclusi, possono
+essere ancora in attesa di moderazione.
+
+Il classificatore viene addestrato dal comando microblog_train_spamfilter e
+salvato in MICROBLOG_BAYES_PATH, gli altri processi rileggono il file quando
+cambia; finché il file non esiste nessun commento viene considerato spam.
+"""
+from django.contrib import comments
+from django.db.models import Q
+
+from microblog import settings
+from microblog.models import Trackback
+
+import cPickle as pickle
+import math
+import os
+import re
+import tempfile
+import threading
+
+_WORD = re.compile(r'\w{2,30}', re.UNICODE)
+_URL = re.compile(r'https?://([^/\s:?#]+)', re.IGNORECASE)
+
+def features(data):
+    """
+    Le caratteristiche (un set di stringhe) del commento descritto da `data`
+    (vedi moderation.request_data).
+    """
+    text = data.get('comment_content') or ''
+    output = set('w:' + w for w in _WORD.findall(text.lower()))
+    domains = _URL.findall(text)
+    output.update('u:' + d.lower() for d in domains)
+    output.add('links:%d' % min(len(domains), 5))
+    url = data.get('comment_author_url')
+    if url:
+        m = _URL.match(url)
+        output.add('au:' + (m.group(1).lower() if m else url.lower()))
+    email = data.get('comment_author_email')
+    if email:
+        output.add('e:' + email.rsplit('@', 1)[-1].lower())
+    ip = data.get('user_ip')
+    if ip:
+        output.add('ip:' + ip)
+        output.add('net:' + ip.rsplit('.', 1)[0])
+    output.add('t:%s' % data.get('comment_type', ''))
+    return output
+
+class NaiveBayes(object):
+    def __init__(self):
+        self.docs = {True: 0, False: 0}
+        self.counts = {True: {}, False: {}}
+
+    def train(self, feats, spam):
+        self.docs[spam] += 1
+        counts = self.counts[spam]
+        for f in feats:
+            counts[f] = counts.get(f, 0) + 1
+
+    def spam_probability(self, feats):
+        """
+        La probabilità che un commento con le caratteristiche passate sia
+        spam; senza esempi di entrambe le classi restituisce 0.5.
+        """
+        ns = self.docs[True]
+        nh = self.docs[False]
+        if not ns or not nh:
+            return 0.5
+        spam = self.counts[True]
+        ham = self.counts[False]
+        score = math.log(ns) - math.log(nh)
+        for f in feats:
+            cs = spam.get(f, 0)
+            ch = ham.get(f, 0)
+            # le caratteristiche mai viste non dicono nulla
+            if cs or ch:
+                score += math.log((cs + 1.0) / (ns + 2)) - math.log((ch + 1.0) / (nh + 2))
+        score = max(-50, min(50, score))
+        return 1.0 / (1.0 + math.exp(-score))
+
+def training_data():
+    """
+    Generatore delle coppie (data, spam) dei commenti e trackback già
+    moderati.
+    """
+    model = comments.get_model()
+    qs = model.objects\
+        .filter(Q(is_public=True) | Q(is_removed=True))\
+        .values_list('comment', 'user_name', 'user_email', 'user_url', 'ip_address', 'is_removed')
+    for text, user, email, url, ip, removed in qs.iterator():
+        data = {
+            'comment_type': 'comment',
+            'comment_content': text,
+            'comment_author': user,
+            'comment_author_email': email,
+            'comment_author_url': url,
+            'user_ip': ip,
+        }
+        yield data, removed
+    # un trackback non ha uno stato "rimosso", quelli non pubblici possono
+    # essere spam o semplicemente in attesa di moderazione
+    qs = Trackback.objects\
+        .filter(is_public=True)\
+        .values_list('title', 'url')
+    for title, url in qs.iterator():
+        data = {
+            'comment_type': 'trackback',
+            'comment_content': title,
+            'comment_author_url': url,
+        }
+        yield data, False
+
+def train(samples=None):
+    """
+    Addestra un nuovo classificatore con le coppie (data, spam) passate (di
+    default quelle di training_data).
+    """
+    if samples is None:
+        samples = training_data()
+    c = NaiveBayes()
+    for data, spam in samples:
+        c.train(features(data), spam)
+    return c
+
+def save(c, path):
+    # scrittura atomica, i processi che rileggono il file non devono mai
+    # vederlo a metà
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump((c.docs, c.counts), f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
+
+def load(path):
+    c = NaiveBayes()
+    with open(path, 'rb') as f:
+        c.docs, c.counts = pickle.load(f)
+    return c
+
+_classifier = None
+_mtime = None
+_lock = threading.Lock()
+
+def classifier():
+    """
+    Il classificatore in uso, letto da MICROBLOG_BAYES_PATH (e riletto
+    quando il file cambia); None se il classificatore non è ancora stato
+    addestrato. L'addestramento legge tutti i commenti e non viene mai
+    eseguito durante una richiesta, solo da retrain.
+    """
+    global _classifier, _mtime
+    path = settings.MICROBLOG_BAYES_PATH
+    with _lock:
+        try:
+            mtime = os.path.getmtime(path) if path else None
+        except OSError:
+            mtime = None
+        if mtime is not None and mtime != _mtime:
+            _classifier = load(path)
+            _mtime = mtime
+        return _classifier
+
+def retrain():
+    """
+    Riaddestra il classificatore e, se MICROBLOG_BAYES_PATH è impostato, lo
+    salva.
+    """
+    global _classifier, _mtime
+    c = train()
+    with _lock:
+        _classifier = c
+        if settings.MICROBLOG_BAYES_PATH:
+            save(c, settings.MICROBLOG_BAYES_PATH)
+            _mtime = os.path.getmtime(settings.MICROBLOG_BAYES_PATH)
+    return c
+
+def is_spam(data):
+    c = classifier()
+    if c is None:
+        # senza classificatore la moderazione resta quella "light"
+        return False
+    return c.spam_probability(features(data)) >= settings.MICROBLOG_BAYES_THRESHOLD
@@ -1,17 +1,15 @@
 # -*- coding: UTF-8 -*-
 import re
-from collections import defaultdict
-from datetime import date
 
 from django import template
 from django.contrib.sites.models import Site
 from django.template import Context
-from django.template.defaultfilters import slugify
 from django.utils.translation import ugettext
 from django.utils.safestring import mark_safe
 
 from microblog import dataaccess
 from microblog import models
+from microblog import pagination
 from microblog import settings
 
 from fancy_tag import fancy_tag
@@ -26,68 +24,70 @@ def _lang(ctx):
     return l.split('-', 1)[0]
 
 @fancy_tag(register, takes_context=True)
-def post_list(context, post_type='any', count=None, year=None, tag=None, category=None, author=None):
-    posts = dataaccess.post_list(_lang(context))
+def post_list(context, post_type='any', count=None, year=None, tag=None, category=None, author=None, cursor=None):
+    """
+    Se `cursor` è specificato (anche come stringa vuota per la prima
+    pagina) restituisce una pagina (vedi pagination.seek) di `count` post,
+    default MICROBLOG_POST_PER_PAGE.
+    """
+    filtered = post_type != 'any' or any(x is not None for x in (year, tag, category, author, count))
+    if filtered and cursor is None and settings.MICROBLOG_POST_FILTER_IS_DEFAULT:
+        # i filtri vengono applicati direttamente nel db, il costo dipende
+        # dal numero di post restituiti e non da quelli esistenti
+        user = context.get('user')
+        return dataaccess.filtered_post_list(
+            _lang(context),
+            not (user and user.is_authenticated()),
+            featured={'featured': True, 'non-featured': False}.get(post_type),
+            year=int(year) if year is not None else None,
+            tag=tag,
+            category=category.id if category is not None else None,
+            author=author.id if author is not None else None,
+            limit=int(count) if count is not None else None)
+
+    posts = dataaccess.post_list(_lang(context)).select(
+        year=int(year) if year is not None else None,
+        tag=tag,
+        category=category.id if category is not None else None,
+        author=author.id if author is not None else None)
     posts = settings.MICROBLOG_POST_FILTER(posts, context.get('user'))
     if post_type == 'featured':
         posts = filter(lambda x: x.featured, posts)
     elif post_type == 'non-featured':
         posts = filter(lambda x: not x.featured, posts)
-    if year is not None:
-        year = int(year)
-        posts = filter(lambda x: x.date.year == year, posts)
-    if tag is not None:
-        tagged = dataaccess.tagged_posts(tag)
-        posts = filter(lambda x: x.id in tagged, posts)
-    if category is not None:
-        posts = filter(lambda x: x.category == category, posts)
-    if author is not None:
-        posts = filter(lambda x: x.author == author, posts)
-    if count is not None:
+    if cursor is not None:
+        posts = pagination.seek(posts, cursor, int(count or settings.MICROBLOG_POST_PER_PAGE))
+    elif count is not None:
         posts = posts[:count]
     return posts
 
+def _archive(context, name):
+    if settings.MICROBLOG_POST_FILTER_IS_DEFAULT:
+        user = context.get('user')
+        stats = dataaccess.archive_stats(_lang(context), not (user and user.is_authenticated()))
+    else:
+        stats = dataaccess.archive_counts(post_list(context))
+    return stats[name]
+
 @fancy_tag(register, takes_context=True)
 def year_list(context):
-    posts = post_list(context)
-    years = defaultdict(lambda: 0)
-    for p in posts:
-        years[date(day=1, month=1, year=p.date.year)] += 1
-    return sorted(years.items())
+    return _archive(context, 'years')
 
 @fancy_tag(register, takes_context=True)
 def month_list(context):
-    posts = post_list(context)
-    months = defaultdict(lambda: 0)
-    for p in posts:
-        months[date(day=1, month=p.date.month, year=p.date.year)] += 1
-    return sorted(months.items())
+    return _archive(context, 'months')
 
 @fancy_tag(register, takes_context=True)
 def author_list(context):
-    posts = post_list(context)
-    authors = defaultdict(lambda: 0)
-    for p in posts:
-        authors[p.author] += 1
-    return sorted(authors.items(), key=lambda x: x[0].first_name + x[0].last_name)
+    return _archive(context, 'authors')
 
 @fancy_tag(register, takes_context=True)
 def category_list(context):
-    posts = post_list(context)
-    categories = defaultdict(lambda: 0)
-    for p in posts:
-        categories[p.category] += 1
-    return sorted(categories.items(), key=lambda x: x[0].name)
+    return _archive(context, 'categories')
 
 @fancy_tag(register, takes_context=True)
 def tags_list(context):
-    posts = post_list(context)
-    tmap = dataaccess.tag_map()
-    tags = defaultdict(lambda: 0)
-    for p in posts:
-        for t in tmap.get(p.id, []):
-            tags[t.name] += 1
-    return sorted(tags.items())
+    return _archive(context, 'tags')
 
 @fancy_tag(register, takes_context=True)
 def opengraph_meta(context, pid):
@@ -112,8 +112,7 @@ def opengraph_meta(context, pid):
 
 @register.filter
 def post_tags(post):
-    tmap = dataaccess.tag_map()
-    return tmap[post.id]
+    return dataaccess.post_tags(post.id)
 
 @fancy_tag(register, takes_context=True)
 def get_post_data(context, pid):
@@ -126,6 +125,10 @@ def get_post_comment(context, post):
 
 @register.inclusion_tag('microblog/show_posts_list.html', takes_context=True)
 def show_posts_list(context, posts):
+    # i singoli show_post_summary richiedono i dati di un post alla volta,
+    # recuperandoli qui tutti insieme li trovano già in cache
+    if posts:
+        dataaccess.post_data_many([ p.id for p in posts ], _lang(context))
     ctx = Context(context)
     ctx.update({
         'posts': posts,
@@ -198,8 +201,9 @@ def prepare_summary(content):
 @register.filter
 def user_name_for_url(user):
     """
+    Lo slug dell'autore, vedi views.author
     """
-    return slugify('%s-%s' % (user.first_name, user.last_name))
+    return models.author_slug(user)
 
 @register.inclusion_tag('microblog/show_post_comments.html', takes_context=True)
 def show_post_comments(context, post):
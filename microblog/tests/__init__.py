@@ -0,0 +1,6 @@
+# -*- coding: UTF-8 -*-
+# il test runner di django (< 1.6) cerca i test solo in microblog.tests
+from microblog.tests.test_cache import *
+from microblog.tests.test_outbox import *
+from microblog.tests.test_moderation import *
+from microblog.tests.test_spamfilter import *
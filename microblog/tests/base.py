@@ -0,0 +1,45 @@
+# -*- coding: UTF-8 -*-
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from microblog import models
+from microblog import settings
+
+from datetime import datetime
+
+def create_content(**kwargs):
+    """
+    Crea un post pubblicato, con il suo autore e la sua categoria, e
+    restituisce il PostContent in inglese; `kwargs` sostituisce i campi di
+    default del PostContent.
+    """
+    user = User.objects.create(username='author', first_name='A', last_name='B')
+    category = models.Category.objects.create(name='news')
+    post = models.Post.objects.create(
+        date=datetime.now(), author=user, status='P', category=category)
+    fields = dict(
+        language='en', headline='Hello', slug='hello',
+        summary='', body='<p>hello world</p>')
+    fields.update(kwargs)
+    return models.PostContent.objects.create(post=post, **fields)
+
+class MicroblogTestCase(TestCase):
+    """
+    Le impostazioni di microblog in `patched` (e quelle cambiate con
+    patch_settings) valgono per la durata di ogni test e vengono
+    ripristinate alla fine.
+    """
+    patched = {}
+
+    def setUp(self):
+        self._settings = {}
+        self.patch_settings(**self.patched)
+
+    def tearDown(self):
+        for k, v in self._settings.items():
+            setattr(settings, k, v)
+
+    def patch_settings(self, **values):
+        for k, v in values.items():
+            self._settings.setdefault(k, getattr(settings, k))
+            setattr(settings, k, v)
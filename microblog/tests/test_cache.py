@@ -0,0 +1,83 @@
+# -*- coding: UTF-8 -*-
+from django.core.cache import cache
+from django.test import TestCase
+
+from microblog.dataaccess import cache_me
+
+import threading
+import time
+
+class StampedeTest(TestCase):
+    """
+    Con `grace` un valore assente viene calcolato da un solo thread, gli
+    altri aspettano il risultato.
+    """
+    def setUp(self):
+        cache.clear()
+
+    def test_cold_key_computed_once(self):
+        calls = []
+        lock = threading.Lock()
+
+        @cache_me(key='m:test:stampede', grace=60, lock_timeout=10)
+        def slow():
+            with lock:
+                calls.append(1)
+            time.sleep(0.3)
+            return 'value'
+
+        results = []
+        def worker():
+            results.append(slow())
+
+        threads = [ threading.Thread(target=worker) for _ in range(20) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 20)
+
+class OldEntryTest(TestCase):
+    """
+    I valori salvati da una versione precedente di cache_me (senza busta)
+    sono trattati come assenti.
+    """
+    def setUp(self):
+        cache.clear()
+
+    def test_unwrapped_entry_is_a_miss(self):
+        @cache_me(key='m:test:old:%s', grace=60)
+        def f(x):
+            return [x, x, x, x]
+
+        for old in ({'a': 1, 'b': 2, 'c': 3, 'd': 4, 'e': 5}, [1, 2, 3, 4], [1, 2]):
+            cache.set(f.cachekey('k'), old)
+            self.assertEqual(f('k'), ['k'] * 4)
+            f.invalidate()
+
+class SetManyTest(TestCase):
+    """
+    Un valore calcolato prima di un'invalidazione non viene salvato come
+    valido da set_many.
+    """
+    def setUp(self):
+        cache.clear()
+
+    def test_invalidated_during_compute(self):
+        db = {1: 'old', 2: 'old'}
+
+        @cache_me(key='m:test:set_many:%s', scope=lambda pid: pid, l1=10)
+        def f(pid):
+            return db[pid]
+
+        versions = {}
+        self.assertEqual(f.get_many([(1,), (2,)], versions), {})
+        computed = dict(((pid,), db[pid]) for pid in (1, 2))
+        # il valore cambia mentre gli altri vengono calcolati
+        db[1] = 'new'
+        f.invalidate(entity=1)
+        f.set_many(computed, versions=versions)
+        self.assertEqual(f.get_many([(1,), (2,)]), {(2,): 'old'})
+        self.assertEqual(f(1), 'new')
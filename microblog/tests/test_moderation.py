@@ -0,0 +1,152 @@
+# -*- coding: UTF-8 -*-
+from django.test.client import RequestFactory
+
+from microblog import models
+from microblog import moderation
+from microblog.tests.base import MicroblogTestCase, create_content
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import threading
+import urlparse
+
+class AkismetHandler(BaseHTTPRequestHandler):
+    # keep-alive, come le API vere
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length'))
+        data = dict(urlparse.parse_qsl(self.rfile.read(length)))
+        method = self.path.rsplit('/', 1)[-1]
+        self.server.calls.append(method)
+        if self.server.down:
+            status, body = 500, 'down'
+        elif method == 'verify-key':
+            status, body = 200, 'valid' if data.get('key') == self.server.key else 'invalid'
+        elif method == 'comment-check':
+            status, body = 200, 'true' if 'viagra' in data.get('comment_content', '') else 'false'
+        else:
+            status, body = 404, 'not found'
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class AkismetServer(ThreadingMixIn, HTTPServer):
+    """
+    Finte API di akismet: la chiave valida è `key`, un commento è spam se
+    contiene la parola "viagra"; con `down` vero tutte le chiamate
+    falliscono.
+    """
+    daemon_threads = True
+
+    def __init__(self, key):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), AkismetHandler)
+        self.key = key
+        self.down = False
+        self.calls = []
+        self.url = 'http://127.0.0.1:%d/1.1/' % self.server_address[1]
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+
+class AkismetTestCase(MicroblogTestCase):
+    def setUp(self):
+        super(AkismetTestCase, self).setUp()
+        self.server = AkismetServer('secret')
+        self.request = RequestFactory().post('/', REMOTE_ADDR='10.0.0.1')
+
+    def tearDown(self):
+        self.server.stop()
+        super(AkismetTestCase, self).tearDown()
+
+    def akismet_client(self, key='secret'):
+        return moderation.AkismetClient(key, 'http://example.com/', self.server.url)
+
+    def data(self, text):
+        return moderation.request_data(self.request, 'comment', text)
+
+class AkismetClientTest(AkismetTestCase):
+    def test_verdicts(self):
+        c = self.akismet_client()
+        self.assertTrue(c.comment_check(self.data('cheap viagra')))
+        self.assertFalse(c.comment_check(self.data('nice post')))
+
+    def test_key_verified_once(self):
+        c = self.akismet_client()
+        for text in ('a', 'b', 'viagra'):
+            c.comment_check(self.data(text))
+        self.assertEqual(self.server.calls, ['verify-key'] + ['comment-check'] * 3)
+
+    def test_invalid_key(self):
+        c = self.akismet_client(key='wrong')
+        self.assertRaises(moderation.AkismetError, c.comment_check, self.data('nice post'))
+        self.assertRaises(moderation.AkismetError, c.comment_check, self.data('nice post'))
+        self.assertEqual(self.server.calls, ['verify-key'])
+
+    def test_threads(self):
+        c = self.akismet_client()
+        results = []
+        def worker(text):
+            results.append((text, c.comment_check(self.data(text))))
+        threads = [ threading.Thread(target=worker, args=(t,)) for t in ('viagra', 'ham') * 5 ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(results), [('ham', False)] * 5 + [('viagra', True)] * 5)
+
+class DeferredModerationTest(AkismetTestCase):
+    patched = {
+        'MICROBLOG_MODERATION_TYPE': 'akismet',
+        'MICROBLOG_MODERATION_DEFER': True,
+    }
+
+    def setUp(self):
+        super(DeferredModerationTest, self).setUp()
+        self._akismet = moderation._akismet
+        moderation._akismet = self.akismet_client()
+        self.content = create_content()
+
+    def tearDown(self):
+        moderation._akismet = self._akismet
+        super(DeferredModerationTest, self).tearDown()
+
+    def trackback(self, title):
+        # come views._trackback_ping
+        self.assertTrue(moderation.moderate(self.request, 'trackback', title, url='http://spam.example.com/'))
+        tb = self.content.new_trackback('http://spam.example.com/', title=title, is_public=False)
+        moderation.defer(self.request, 'trackback', tb, title, url='http://spam.example.com/')
+        return tb
+
+    def test_moderate_does_not_call_akismet(self):
+        self.trackback('cheap viagra')
+        self.assertEqual(self.server.calls, [])
+        self.assertEqual(models.ModerationJob.objects.count(), 1)
+
+    def test_process_pending(self):
+        spam = self.trackback('cheap viagra')
+        ham = self.trackback('nice post')
+        self.assertEqual(moderation.process_pending(), (1, 1))
+        self.assertFalse(models.Trackback.objects.get(id=spam.id).is_public)
+        self.assertTrue(models.Trackback.objects.get(id=ham.id).is_public)
+        self.assertFalse(models.ModerationJob.objects.exists())
+
+    def test_failed_check_retried(self):
+        tb = self.trackback('nice post')
+        self.server.down = True
+        self.assertEqual(moderation.process_pending(), (0, 0))
+        self.assertEqual(models.ModerationJob.objects.count(), 1)
+        self.assertFalse(models.Trackback.objects.get(id=tb.id).is_public)
+        self.server.down = False
+        self.assertEqual(moderation.process_pending(), (1, 0))
+        self.assertTrue(models.Trackback.objects.get(id=tb.id).is_public)
@@ -0,0 +1,217 @@
+# -*- coding: UTF-8 -*-
+from django.core import mail
+from django.test.utils import override_settings
+
+from microblog import models
+from microblog import outbox
+from microblog import settings
+from microblog.tests.base import MicroblogTestCase, create_content
+
+from datetime import datetime, timedelta
+import asyncore
+import smtpd
+import smtplib
+import socket
+import threading
+import time
+
+class SMTPServer(smtpd.SMTPServer):
+    """
+    Server SMTP locale, conserva i messaggi ricevuti come coppie
+    (destinatari, messaggio).
+    """
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.rejected = set()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            asyncore.loop(timeout=0.05, count=1)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if self.rejected.intersection(rcpttos):
+            return '554 rejected'
+        self.messages.append((rcpttos, data))
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.close()
+
+class FakeTwitter(object):
+    """
+    Sostituisce il modulo twitter, registra gli status inviati invece di
+    contattare le API.
+    """
+    def __init__(self, error=None, delay=0):
+        self.updates = []
+        self.error = error
+        self.delay = delay
+
+    def Api(self, username, password):
+        return self
+
+    def PostUpdate(self, status):
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        self.updates.append(status)
+
+class OutboxTestCase(MicroblogTestCase):
+    patched = {
+        'MICROBLOG_OUTBOX': True,
+        'MICROBLOG_OUTBOX_MAX_ATTEMPTS': 3,
+        'MICROBLOG_OUTBOX_RETRY_DELAY': 60,
+        'MICROBLOG_OUTBOX_LEASE': 600,
+        'MICROBLOG_EMAIL_RECIPIENTS': ['a@example.com', 'b@example.com'],
+        'MICROBLOG_EMAIL_BATCH_SIZE': 100,
+        'MICROBLOG_EMAIL_CONNECTIONS': 1,
+        'MICROBLOG_TWITTER_USERNAME': 'microblog',
+        'MICROBLOG_TWITTER_DEBUG': False,
+        'MICROBLOG_TWITTER_POST_URL_MANGLER': lambda c: 'http://example.com/%s' % c.slug,
+    }
+
+    def setUp(self):
+        super(OutboxTestCase, self).setUp()
+        self._publishers = dict(models.PUBLISHERS)
+        models.PUBLISHERS.clear()
+        models.PUBLISHERS['e'] = models.Publisher(models.deliver_email, None, '')
+        models.PUBLISHERS['t'] = models.Publisher(models.deliver_twitter, None, '')
+
+        self._twitter = getattr(models, 'twitter', None)
+        self.twitter = FakeTwitter()
+        models.twitter = self.twitter
+
+        self.smtp = SMTPServer()
+        self._email = override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1',
+            EMAIL_PORT=self.smtp.port)
+        self._email.enable()
+
+        self.content = create_content()
+        # con le integrazioni attive il salvataggio ha già messo in coda dei
+        # job, i test creano i loro
+        models.OutboxJob.objects.all().delete()
+
+    def tearDown(self):
+        self._email.disable()
+        self.smtp.stop()
+        if self._twitter is None:
+            del models.twitter
+        else:
+            models.twitter = self._twitter
+        models.PUBLISHERS.clear()
+        models.PUBLISHERS.update(self._publishers)
+        super(OutboxTestCase, self).tearDown()
+
+    def job(self, method):
+        return models.OutboxJob.objects.create(
+            content=self.content, method=method, next_attempt=datetime.now())
+
+    def reload(self, job):
+        return models.OutboxJob.objects.get(id=job.id)
+
+class EmailOutboxTest(OutboxTestCase):
+    def test_delivered(self):
+        job = self.job('e')
+        self.assertEqual(outbox.process_queue(), {'delivered': 1, 'failed': 0, 'skipped': 0})
+        self.assertEqual(
+            sorted(r for rcpts, _ in self.smtp.messages for r in rcpts),
+            ['a@example.com', 'b@example.com'])
+        self.assertEqual(
+            sorted(models.Spam.objects.filter(method='e').values_list('value', flat=True)),
+            ['a@example.com', 'b@example.com'])
+        self.assertEqual(self.reload(job).status, 'd')
+
+    def test_already_sent_skipped(self):
+        models.Spam.objects.create(post=self.content.post, method='e', value='a@example.com')
+        self.job('e')
+        outbox.process_queue()
+        self.assertEqual([ rcpts for rcpts, _ in self.smtp.messages ], [['b@example.com']])
+
+    def test_smtp_down_retried(self):
+        # una porta su cui non risponde nessuno
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        job = self.job('e')
+        with self.settings(EMAIL_PORT=port):
+            self.assertEqual(outbox.process_queue()['failed'], 1)
+        job = self.reload(job)
+        self.assertEqual(job.status, 'q')
+        self.assertEqual(job.attempts, 1)
+        self.assertTrue(job.next_attempt > datetime.now() + timedelta(seconds=30))
+        self.assertFalse(models.Spam.objects.exists())
+        # il job non è ancora in scadenza
+        self.assertEqual(outbox.due_jobs(), [])
+
+class SendEmailsTest(OutboxTestCase):
+    def test_partial_failure(self):
+        self.smtp.rejected.add('b@example.com')
+        post = self.content.post
+        messages = [
+            (mail.EmailMessage('s', 'b', 'blog@example.com', [r]), [models.Spam(post=post, method='e', value=r)])
+            for r in ('a@example.com', 'b@example.com', 'c@example.com') ]
+        self.assertRaises(smtplib.SMTPException, models.send_emails, messages)
+        # il messaggio inviato prima dell'errore è registrato
+        self.assertEqual(
+            list(models.Spam.objects.values_list('value', flat=True)),
+            ['a@example.com'])
+
+class TwitterOutboxTest(OutboxTestCase):
+    def test_delivered_once(self):
+        self.job('t')
+        outbox.process_queue()
+        self.assertEqual(len(self.twitter.updates), 1)
+        self.assertTrue('http://example.com/hello' in self.twitter.updates[0])
+        self.job('t')
+        outbox.process_queue()
+        self.assertEqual(len(self.twitter.updates), 1)
+
+    def test_failure(self):
+        self.twitter.error = IOError('twitter is down')
+        job = self.job('t')
+        for attempt in range(settings.MICROBLOG_OUTBOX_MAX_ATTEMPTS):
+            models.OutboxJob.objects.filter(id=job.id).update(next_attempt=datetime.now())
+            outbox.process_queue()
+        job = self.reload(job)
+        self.assertEqual(job.status, 'f')
+        self.assertTrue('twitter is down' in job.last_error)
+        self.assertFalse(models.Spam.objects.exists())
+
+    def test_claimed_once(self):
+        job = self.job('t')
+        other = self.reload(job)
+        self.assertTrue(outbox.run_job(job))
+        self.assertEqual(outbox.run_job(other), None)
+
+class LeaseTest(OutboxTestCase):
+    def test_renewed_during_delivery(self):
+        renewed = []
+        original = outbox._renew
+        outbox._renew = lambda job: renewed.append(job.id) or True
+        try:
+            settings.MICROBLOG_OUTBOX_LEASE = 0.3
+            self.twitter.delay = 0.5
+            job = self.job('t')
+            self.assertTrue(outbox.run_job(job))
+        finally:
+            outbox._renew = original
+        self.assertTrue(renewed)
+        self.assertEqual(set(renewed), set([job.id]))
+
+    def test_renew(self):
+        job = self.job('t')
+        self.assertTrue(outbox._claim(job))
+        self.assertTrue(outbox._renew(job))
+        # il job è stato ripreso da un altro worker
+        models.OutboxJob.objects.filter(id=job.id).update(attempts=job.attempts + 1)
+        self.assertFalse(outbox._renew(job))
@@ -0,0 +1,50 @@
+# -*- coding: UTF-8 -*-
+from microblog import settings
+from microblog import spamfilter
+from microblog.tests.base import MicroblogTestCase, create_content
+
+import os
+import shutil
+import tempfile
+
+class SpamFilterTest(MicroblogTestCase):
+    def setUp(self):
+        super(SpamFilterTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.patch_settings(
+            MICROBLOG_BAYES_PATH=os.path.join(self.dir, 'bayes'),
+            # con pochi esempi le probabilità restano lontane da 0 e 1
+            MICROBLOG_BAYES_THRESHOLD=0.5)
+        spamfilter._classifier = spamfilter._mtime = None
+        self.content = create_content()
+
+    def tearDown(self):
+        spamfilter._classifier = spamfilter._mtime = None
+        shutil.rmtree(self.dir)
+        super(SpamFilterTest, self).tearDown()
+
+    def test_pending_trackbacks_not_used(self):
+        self.content.new_trackback('http://good.example.com/', title='public')
+        self.content.new_trackback('http://pending.example.com/', title='pending', is_public=False)
+        samples = [ (data['comment_content'], spam) for data, spam in spamfilter.training_data()
+            if data['comment_type'] == 'trackback' ]
+        self.assertEqual(samples, [('public', False)])
+
+    def test_untrained(self):
+        # senza il file il classificatore non viene addestrato durante la
+        # richiesta e niente è spam
+        with self.assertNumQueries(0):
+            self.assertEqual(spamfilter.classifier(), None)
+            self.assertFalse(spamfilter.is_spam({'comment_content': 'cheap viagra'}))
+        self.assertFalse(os.path.exists(settings.MICROBLOG_BAYES_PATH))
+
+    def test_retrain(self):
+        samples = [
+            ({'comment_content': 'cheap viagra now'}, True),
+            ({'comment_content': 'viagra pills'}, True),
+            ({'comment_content': 'nice post, thanks'}, False),
+            ({'comment_content': 'thanks for the post'}, False),
+        ]
+        spamfilter.save(spamfilter.train(samples), settings.MICROBLOG_BAYES_PATH)
+        self.assertTrue(spamfilter.is_spam({'comment_content': 'viagra'}))
+        self.assertFalse(spamfilter.is_spam({'comment_content': 'thanks'}))
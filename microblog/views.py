@@ -1,14 +1,12 @@
 # -*- coding: UTF-8 -*-
 from django.conf import settings as dsettings
-from django.contrib.auth import models as authModels
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
 from django.http import HttpResponse, Http404
 from django.shortcuts import render, render_to_response, get_object_or_404
 from django.template import RequestContext
-from django.template.defaultfilters import slugify
 from django.utils.translation import get_language
 
-from microblog import models, settings
+from microblog import dataaccess, models, pagination, settings
 
 from taggit.models import Tag, TaggedItem
 from decorator import decorator
@@ -44,7 +42,15 @@ def render_json(f):
     return decorator(wrapper, f)
 
 def post_list(request):
-    return render(request, 'microblog/post_list.html', {})
+    ctx = {}
+    if settings.MICROBLOG_POST_LIST_PAGINATION:
+        # la stessa lista del tag post_list, con lo stesso filtro sui post
+        # visibili all'utente
+        posts = dataaccess.post_list(get_language().split('-', 1)[0])
+        posts = settings.MICROBLOG_POST_FILTER(posts, request.user)
+        ctx['paginated'] = True
+        ctx['page'] = _paginate_posts(posts, request)
+    return render(request, 'microblog/post_list.html', ctx)
 
 def category(request, category):
     category = get_object_or_404(models.Category, name=category)
@@ -77,14 +83,14 @@ def tag(request, tag):
     )
 
 def author(request, author):
-    user = [
-        u for u in authModels.User.objects.all()
-        if slugify('%s-%s' % (u.first_name, u.last_name)) == author
-    ]
-    if not user:
+    try:
+        user = models.Author.objects\
+            .select_related('user')\
+            .filter(slug=author)\
+            .order_by('user')[0]\
+            .user
+    except IndexError:
         raise Http404()
-    else:
-        user = user[0]
 
     return render_to_response(
         'microblog/author.html',
@@ -95,7 +101,15 @@ def author(request, author):
     )
 
 def _paginate_posts(post_list, request):
-    if settings.MICROBLOG_POST_LIST_PAGINATION:
+    if not settings.MICROBLOG_POST_LIST_PAGINATION:
+        return pagination.SeekPage(post_list)
+    elif settings.MICROBLOG_POST_LIST_PAGINATION_MODE == 'seek':
+        return pagination.seek(
+            post_list,
+            request.GET.get('cursor'),
+            settings.MICROBLOG_POST_PER_PAGE,
+            with_count=settings.MICROBLOG_POST_LIST_PAGINATION_COUNT)
+    else:
         paginator = Paginator(post_list, settings.MICROBLOG_POST_PER_PAGE)
         try:
             page = int(request.GET.get("page", "1"))
@@ -106,9 +120,6 @@ def _paginate_posts(post_list, request):
             posts = paginator.page(page)
         except (EmptyPage, InvalidPage):
             posts = paginator.page(1)
-    else:
-        paginator = Paginator(post_list, len(post_list) or 1)
-        posts = paginator.page(1)
 
     return posts
 
@@ -118,10 +129,14 @@ def _posts_list(request, featured=False):
     else:
         lang = request.LANGUAGE_CODE
 
+    entries = models.PublishedEntry.objects.published()
+    if featured is not None:
+        entries = entries.filter(featured=featured)
+    if lang is not None:
+        entries = entries.byLanguage(lang)
     return models.Post.objects\
-        .byLanguage(lang)\
-        .byFeatured(featured)\
-        .published()
+        .filter(id__in=entries.values('post'))\
+        .order_by('-date', '-id')
 
 def _post_detail(request, content):
     if not settings.MICROBLOG_POST_FILTER([content.post], request.user):
@@ -159,11 +174,11 @@ def _trackback_ping(request, content):
         'excerpt': request.POST.get('excerpt', ''),
     }
 
-    from microblog.moderation import moderate
-    if not moderate(request, 'trackback', t['title'], url=t['url']):
-        return failure('moderated')
-
-    content.new_trackback(**t)
+    from microblog import moderation
+    moderated = moderation.moderate(request, 'trackback', t['title'], url=t['url'])
+    tb = content.new_trackback(is_public=not moderated, **t)
+    if moderated and moderation.deferred():
+        moderation.defer(request, 'trackback', tb, t['title'], url=t['url'])
     return success()
 
 @render_json
@@ -26,6 +26,7 @@ setup(name='microblog',
         'microblog.management.commands',
         'microblog.migrations',
         'microblog.templatetags',
+        'microblog.tests',
         'microblog.utils',
     ],
     package_data={